@@ -1,7 +1,149 @@
 import numpy as np
-from parameters import C_VALUES, T_VALUES
+from collections import OrderedDict
+from parameters import C_VALUES, T_VALUES, LUT_CACHE_BYTES
 from math_functions import magnitude
 
+# Gauss-Legendre weights and abscissae as arrays for batched quadrature
+GL_WEIGHTS = np.array(C_VALUES)
+GL_NODES = np.array(T_VALUES)
+
+
+## Batched evaluation
+# Curves are given as stacked control points with shape (..., 4, 2).
+# t may be a scalar, an array of t-values shared by every curve, or an array with
+# a leading axis matching the curves to evaluate each curve at its own t-values.
+
+def bernstein_basis(t):
+    """
+    Cubic Bernstein basis for an array of t in [0,1], shape t.shape + (4,)
+    """
+    t = np.asarray(t, dtype=float)
+    s = 1 - t
+    return np.stack((s*s*s, 3*s*s*t, 3*s*t*t, t*t*t), axis=-1)
+
+
+def bernstein_derivative_basis(t):
+    """
+    Derivative of the cubic Bernstein basis for an array of t in [0,1], shape t.shape + (4,)
+    """
+    t = np.asarray(t, dtype=float)
+    s = 1 - t
+    return np.stack((-3*s*s, 3*s*s - 6*s*t, 6*s*t - 3*t*t, 3*t*t), axis=-1)
+
+
+def interpolate_curves(control_points, t):
+    """
+    Compute the points of the Bezier curves at the specified t-values
+    """
+    return bernstein_basis(t) @ control_points
+
+
+def tangent_curves(control_points, t):
+    """
+    Compute the derivatives of the Bezier curves at the specified t-values
+    """
+    return bernstein_derivative_basis(t) @ control_points
+
+
+def normal_curves(control_points, t):
+    """
+    Compute the unit normals of the Bezier curves at the specified t-values
+    Normals point to the left of the direction of travel, as in get_orthonormal_vector
+    """
+    tan = tangent_curves(control_points, t)
+    mag = np.hypot(tan[..., 0], tan[..., 1])[..., None]
+    return np.stack((-tan[..., 1], tan[..., 0]), axis=-1) / mag
+
+
+def arclength_curves(control_points, t=1.0):
+    """
+    Compute the arc-length of the Bezier curves from 0 to the specified t-values
+    using Gaussian Quadrature with a change of limits from [-1,1] to [0,t]
+    """
+    t = np.asarray(t, dtype=float)
+    u = 0.5 * t[..., None] * (GL_NODES + 1)
+
+    if t.ndim:
+        # flatten the quadrature nodes of every t-value into one evaluation
+        u = u.reshape(u.shape[:-2] + (-1,))
+
+    tan = tangent_curves(control_points, u)
+    speed = np.hypot(tan[..., 0], tan[..., 1])
+
+    if t.ndim:
+        speed = speed.reshape(speed.shape[:-1] + (t.shape[-1], len(GL_NODES)))
+
+    return 0.5 * t * (speed @ GL_WEIGHTS)
+
+
+def stack_control_points(beziers):
+    """
+    Stack the control points of a list of Bezier and LinearBezier curves into an
+    array of shape (len(beziers), 4, 2)
+    """
+    return np.stack([bezier.control_points for bezier in beziers])
+
+
+class LUTCache:
+    """
+    Least-recently-used cache of Bezier look-up tables shared by every curve.
+    Tables are keyed by the control points and resolution of the curve and the
+    total size of the cached tables is bounded by max_bytes.
+    """
+    def __init__(self, max_bytes=LUT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.tables = OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, control_points, n):
+        key = (control_points.tobytes(), n)
+
+        table = self.tables.get(key)
+        if table is not None:
+            self.hits += 1
+            self.tables.move_to_end(key)
+            return table
+
+        self.misses += 1
+        table = interpolate_curves(control_points, np.linspace(0, 1, n))
+        # tables are shared between curves with the same control points
+        table.setflags(write=False)
+
+        self.tables[key] = table
+        self.nbytes += table.nbytes
+
+        # evict the least recently used tables, always keeping the newest one
+        while self.nbytes > self.max_bytes and len(self.tables) > 1:
+            _, old = self.tables.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+        return table
+
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.tables),
+            'nbytes': self.nbytes,
+        }
+
+
+    def clear(self):
+        self.tables.clear()
+        self.nbytes = 0
+
+
+LUT_CACHE = LUTCache()
+
+
 class Bezier:
     def __init__(self, P0, P1, P2, P3):
         self.P0 = P0
@@ -9,7 +151,7 @@ class Bezier:
         self.P2 = P2
         self.P3 = P3
 
-        self.LUT_cache = None
+        self.control_points = np.array([P0, P1, P2, P3], dtype=float)
     
 
     def __repr__(self):
@@ -19,56 +161,42 @@ class Bezier:
     def interpolate(self, t):
         """
         Compute the value of the Bezier fucntion at the specified t in [0,1]
+        t may be a scalar or an array of t-values
         """
-        t2 = t*t
-        t3 = t2*t
-        a = (1 + 3*(t2 - t) - t3) * self.P0
-        b = 3*(t -2*t2 + t3) * self.P1
-        c = 3*(t2 - t3) * self.P2
-        d = t3 * self.P3
-        return a + b + c + d
+        return interpolate_curves(self.control_points, t)
     
     
     def LUT(self, n=100):
         """
-        Compute and cache a look-up table (LUT) with n evenly-spaced t-values
+        Look up a table of the curve at n evenly-spaced t-values, shape (n, 2)
+        Tables are computed on first use and kept in the shared LUT_CACHE
         """
-        if self.LUT_cache and len(self.LUT) == n:
-            # already computed
-            ...
-        else:
-            # need to recompute
-            ts = np.linspace(0, 1, n)
-            self.LUT_cache = [self.interpolate(t) for t in ts]
-
-        return self.LUT_cache
+        return LUT_CACHE.get(self.control_points, n)
     
 
     def tangent(self, t):
         """
         Compute the derivative of the Bezier function at the specified t in [0,1]
+        t may be a scalar or an array of t-values
         """
-        a = 3*(1-t)*(1-t) * (self.P1-self.P0)
-        b = 6*t*(1-t) * (self.P2-self.P1)
-        c = 3*t*t * (self.P3-self.P2)
-        return a + b + c
-        return 3*(1-t)**2 * (self.P1-self.P0) + 6*t*(1-t) * (self.P2-self.P1) + 3*t**2 * (self.P3-self.P2)
+        return tangent_curves(self.control_points, t)
 
 
-    def arclength(self):
+    def normal(self, t):
         """
-        Utilize Gaussian Quadrature with change of limits from [-1,1] to [0,1]
-        https://www.youtube.com/watch?v=Uf3l3hMZecA
+        Compute the unit normal of the Bezier function at the specified t in [0,1]
+        t may be a scalar or an array of t-values
         """
-        n = len(T_VALUES)
+        return normal_curves(self.control_points, t)
+
 
-        cum_len = 0
-        for c, t in zip(C_VALUES, T_VALUES):
-            t = 0.5 * t + 0.5
-            l = magnitude(vec=self.tangent(t))
-            cum_len += c * l
-        
-        return 0.5 * cum_len
+    def arclength(self, t=1.0):
+        """
+        Utilize Gaussian Quadrature with change of limits from [-1,1] to [0,t]
+        https://www.youtube.com/watch?v=Uf3l3hMZecA
+        t may be a scalar or an array of t-values
+        """
+        return arclength_curves(self.control_points, t)
 
 
 class LinearBezier:
@@ -76,7 +204,10 @@ class LinearBezier:
         self.P0 = P0
         self.P1 = P1
 
-        self.LUT_cache = None
+        # equivalent cubic control points for batched evaluation alongside Beziers;
+        # trisecting the segment keeps the parameterization linear in t
+        P0, P1 = np.asarray(P0, dtype=float), np.asarray(P1, dtype=float)
+        self.control_points = np.array([P0, (2*P0 + P1)/3, (P0 + 2*P1)/3, P1])
     
 
     def __repr__(self):
@@ -86,35 +217,40 @@ class LinearBezier:
     def interpolate(self, t):
         """
         Compute the value of the Bezier fucntion at the specified t in [0,1]
+        t may be a scalar or an array of t-values
         """
+        t = np.asarray(t, dtype=float)[..., None]
         return (1 - t) * self.P0 + t * self.P1
     
     
     def LUT(self, n=100):
         """
-        Compute and cache a look-up table (LUT) with n evenly-spaced t-values
+        Look up a table of the curve at n evenly-spaced t-values, shape (n, 2)
+        Tables are computed on first use and kept in the shared LUT_CACHE
         """
-        if self.LUT_cache and len(self.LUT) == n:
-            # already computed
-            ...
-        else:
-            # need to recompute
-            ts = np.linspace(0, 1, n)
-            self.LUT_cache = [self.interpolate(t) for t in ts]
-
-        return self.LUT_cache
+        return LUT_CACHE.get(self.control_points, n)
     
 
     def tangent(self, t):
         """
         Compute the derivative of the Bezier function at the specified t in [0,1]
+        t may be a scalar or an array of t-values
         """
-        return self.P1 - self.P0
+        t = np.asarray(t, dtype=float)
+        return np.broadcast_to(self.P1 - self.P0, t.shape + (2,))
 
 
-    def arclength(self):
+    def normal(self, t):
         """
-        Utilize Gaussian Quadrature with change of limits from [-1,1] to [0,1]
-        https://www.youtube.com/watch?v=Uf3l3hMZecA
+        Compute the unit normal of the Bezier function at the specified t in [0,1]
+        t may be a scalar or an array of t-values
+        """
+        return normal_curves(self.control_points, t)
+
+
+    def arclength(self, t=1.0):
+        """
+        Length of the segment from 0 to the specified t in [0,1]
+        t may be a scalar or an array of t-values
         """
-        return magnitude(endpoints=(self.P0, self.P1))
\ No newline at end of file
+        return np.asarray(t, dtype=float) * magnitude(endpoints=(self.P0, self.P1))
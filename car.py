@@ -1,37 +1,56 @@
-from scipy.interpolate import interp1d
 import random
 from math import sqrt
 from parameters import *
 
 from bezier import Bezier
-from math_functions import get_unit_vec
 from junction import *
 
 import logging
 
 class Car:
+    # fixed attribute layout, no per-instance __dict__
+    __slots__ = (
+        'v_0', 'T', 'a', 'b', 's_0', 'l', 'delta', 'max_v', 'min_v',
+        '_x', '_v', '_acc', 'engine', 'slot',
+        'car_id', 'lane', 'lead_car', 'trail_car', 'destination',
+    )
+
+    # fields reported by get_diagnostics, in display order
+    DIAGNOSTIC_FIELDS = (
+        'car_id', 'lane', 'x', 'v', 'acc', 't',
+        'v_0', 'T', 'a', 'b', 's_0', 'l', 'delta', 'max_v', 'min_v',
+        'lead_car', 'trail_car', 'destination',
+    )
+
+    # fields that fully describe a car apart from its lane, see get_state
+    STATE_FIELDS = (
+        'car_id', 'v_0', 'T', 'a', 'b', 's_0', 'l', 'delta', 'max_v', 'min_v', 'x', 'v', 'destination',
+    )
+
     def __init__(self, car_args, car_id, lane):
         # variables for the intelligent driver model
 
-        # currently all the distances and speeds are in pixels and pixels/frame
-        # let 2 pixel = 1 meter
-        self.dt = 1/60 # 1/60th of a second = spf
+        # distances are in pixels and times in seconds, independent of the frame rate
+        # let PPM pixels = 1 meter
 
-        self.__dict__.update(**car_args)
+        # state is stored locally until the car is bound to a VectorEngine
+        self.engine = None
+        self.slot = None
 
-        self.v_0 = self.v_0*PPM*self.dt # desired velocity (pixels/second)
-        self.T = self.T/self.dt # desired time headway (min time to vehicle ahead)
-        self.b = self.b*PPM*(self.dt**2) # max deceleration (comfortable)
-        self.a = self.a*PPM*(self.dt**2)
-        self.v = self.v*self.v_0 # cars start at half the desired velocity
+        self.v_0 = car_args['v_0']*PPM # desired velocity (pixels/second)
+        self.T = car_args['T'] # desired time headway in seconds (min time to vehicle ahead)
+        self.b = car_args['b']*PPM # max deceleration (comfortable) in pixels/second^2
+        self.a = car_args['a']*PPM # max acceleration in pixels/second^2
+        self.v = car_args['v']*self.v_0 # cars start at half the desired velocity
         # IF THIS NUMBER IS TOO LOW OR b IS TOO LOW, CARS WILL COLLIDE WHICH CURRENTLY CAUSES
         # ISSUES WITH DISAPPEARING VEHICLES 
-        self.s_0 = self.s_0*PPM # minimum spacing (gap between car ahead)
-        self.l = self.l*PPM
+        self.s_0 = car_args['s_0']*PPM # minimum spacing (gap between car ahead)
+        self.l = car_args['l']*PPM
+        self.delta = car_args['delta']
 
         # initialization
         self.x = 0
-        self.t = 0
+        self.acc = 0
         self.max_v = 1.2*self.v_0
         self.min_v = 0
 
@@ -39,15 +58,12 @@ class Car:
         self.car_id = car_id
         self.lane = lane
 
-        self.lead_car = self.lane.last_car
-        self.lane.last_car = self
-        self.lane.cars[self.car_id] = self
-        if self.lead_car:
-            self.lead_car.trail_car = self
+        self.lead_car = None
         self.trail_car = None
 
-        # drawing init
-        self.drawing_init()
+        # destination road when following a route, otherwise junctions are taken at random
+        self.destination = None
+        self.lane.insert_car(self)
 
     
     def __repr__(self):
@@ -55,38 +71,90 @@ class Car:
     
 
     def get_diagnostics(self):
-        return self.__dict__
+        return {field: getattr(self, field) for field in self.DIAGNOSTIC_FIELDS}
 
 
-    def drawing_init(self):
-        self.unit_vec = self.lane.road.unit_vec
-        (x1, y1), (x2, y2) = self.lane.endpoints
+    def get_state(self):
+        """
+        Plain, picklable snapshot of the car in simulation units
+        """
+        return {field: getattr(self, field) for field in self.STATE_FIELDS}
 
-        self.xpos = interp1d((0.0, 1.0), (x1, x2))
-        self.ypos = interp1d((0.0, 1.0), (y1, y2))
-    
 
-    def compute_pos(self):
-        # we can consider t to represent the proportion of the road through
-        # which the car has progressed and use interpolation to compute the
-        # coordinates/position of the car relative to the entire simulation        
-        d = self.t * len(self.lane.beziers) # t / (1/len)
-        r = d % 1
+    @classmethod
+    def from_state(cls, state, lane):
+        """
+        Rebuild a car from get_state and insert it into the lane at its position
+        """
+        car = cls.__new__(cls)
+        car.engine = None
+        car.slot = None
+        car.acc = 0
+        for field in cls.STATE_FIELDS:
+            setattr(car, field, state[field])
 
-        bezier_pos = self.lane.beziers[int(d)].interpolate
+        car.lane = lane
+        car.lead_car = None
+        car.trail_car = None
+        lane.insert_car(car)
 
-        return bezier_pos(r)
-    
+        return car
 
-    def compute_orientation(self):
-        d = self.t * len(self.lane.beziers) # t / (1/len)
-        r = d % 1
 
-        bezier_tan = self.lane.beziers[int(d)].tangent
+    @property
+    def x(self):
+        return self._x if self.engine is None else self.engine.x[self.slot]
 
-        tan = bezier_tan(r)
-        
-        return get_unit_vec(tan.tolist())
+
+    @x.setter
+    def x(self, x):
+        if self.engine is None:
+            self._x = x
+        else:
+            self.engine.x[self.slot] = x
+
+
+    @property
+    def v(self):
+        return self._v if self.engine is None else self.engine.v[self.slot]
+
+
+    @v.setter
+    def v(self, v):
+        if self.engine is None:
+            self._v = v
+        else:
+            self.engine.v[self.slot] = v
+
+
+    @property
+    def acc(self):
+        # acceleration over the last step
+        return self._acc if self.engine is None else self.engine.acc[self.slot]
+
+
+    @acc.setter
+    def acc(self, acc):
+        if self.engine is None:
+            self._acc = acc
+        else:
+            self.engine.acc[self.slot] = acc
+
+
+    @property
+    def t(self):
+        # proportion of the lane through which the car has progressed
+        return self.x/self.lane.length
+    
+
+    def compute_pos(self):
+        # position along the lane is an arc-length, so look the coordinates up in the
+        # lane's arc-length table to keep speeds uniform across curved segments
+        return self.lane.get_position(self.x)
+    
+
+    def compute_orientation(self):
+        return self.lane.get_heading(self.x)
     
 
     # return a tuple of the new lead and trail car if the lane is changed into
@@ -96,70 +164,31 @@ class Car:
         lookahead = self.x + self.l/2 + self.s_0
         lookbehind = self.x - (self.l/2 + self.s_0)
 
-        if not lane.cars:
-            return (None, None)
-
-        for car in lane.cars.values():
-            front = car.x + car.l/2
-            rear = car.x - car.l/2
-
-            # 3 cases:
-            # 1) behind the rearmost car
-            # 2) in front of the frontmost car
-            # 3) between 2 cars
-
-            if lookahead < rear:
-                # behind the other car
-
-                if car.trail_car:
-                    # there is another car behind us
-                    front = car.trail_car.x + car.trail_car.l/2
-                    if lookbehind > front:
-                        # between cars
-                        return (car, car.trail_car)
-                    
-                    # can't be certain
-                    continue
-                
-                else:
-                    # behind the last car in the new lane
-                    return (car, None)
-                
-            elif lookbehind > front:
-                # ahead of the other car
-
-                if car.lead_car:
-                    # there is another car in front of us
-                    # check if we are also clear of the car in front of it
-                    rear = car.lead_car.x - car.lead_car.l/2
-
-                    if lookahead < rear:
-                        # between cars
-                        return (car.lead_car, car)
-                    
-                    # can't be certain
-                    continue
-
-                else:
-                    # ahead of the first car in the new lane
-                    return (None, car)
-
-        # not enough space   
-        return None
-
-
-    def change_lane(self, direction=None):
+        lead, trail = lane.get_neighbors(self.x)
+
+        if lead and lookahead >= lead.x - lead.l/2:
+            # too close to the car ahead
+            return None
+
+        if trail and lookbehind <= trail.x + trail.l/2:
+            # too close to the car behind
+            return None
+
+        return (lead, trail)
+
+
+    def change_lane(self, direction=None, rng=random):
         curr_lane = self.lane
 
         if not direction:
             lanes = [lane for lane in [curr_lane.left_lane, curr_lane.right_lane] if lane]
-            lane = random.choice(lanes) if lanes else None
+            lane = rng.choice(lanes) if lanes else None
         else:
             # car wishes to change to a specific lane
-            if direction == 'L' and lane.left_lane:
-                lane = lane.left_lane
-            elif direction == 'R' and lane.right_lane:
-                lane = lane.right_lane
+            if direction == 'L' and curr_lane.left_lane:
+                lane = curr_lane.left_lane
+            elif direction == 'R' and curr_lane.right_lane:
+                lane = curr_lane.right_lane
             else:
                 logging.warning(f'Invalid lane change direction {direction}.')
                 lane = None
@@ -172,64 +201,11 @@ class Car:
 
         if can_change:
             # do lane change
-            lead, trail = can_change
-
-            ## Update the old lane and cars
-            if not(self.lead_car or self.trail_car):
-                # we are the only car
-                curr_lane.last_car = None
-            else:
-                # there is at least 1 other car in the old lane
-                if self.lead_car:
-                    if self.trail_car:
-                        # we are a central car
-                        self.lead_car.trail_car = self.trail_car
-                        self.trail_car.lead_car = self.lead_car
-                    else:
-                        # we are the rearmost car
-                        self.lead_car.trail_car = None
-                        curr_lane.last_car = self.lead_car
-
-                else:
-                    if self.trail_car:
-                        # we are the frontmost car
-                        self.trail_car.lead_car = None
-            del curr_lane.cars[self.car_id]
-
-            ## Update the new lane and cars
-            if not(lead or trail):
-                # moving into an empty lane
-                lane.last_car = self
-                self.lead_car = None
-                self.trail_car = None
-            else:
-                # there is at least one other car in the new lane
-                if lead:
-                    if trail:
-                        # moving in between two cars
-                        lead.trail_car = self
-                        trail.lead_car = self
-                        self.lead_car = lead
-                        self.trail_car = trail
-                    
-                    else:
-                        # moving to the back of all other cars
-                        lead.trail_car = self
-                        self.lead_car = lead
-                        self.trail_car = None
-                        lane.last_car = self
-                
-                else:
-                    if trail:
-                        # moving the front of all other cars
-                        trail.lead_car = self
-                        self.lead_car = None
-                        self.trail_car = trail
-            
-            lane.cars[self.car_id] = self
+            curr_lane.remove_car(self)
             self.lane = lane
-
-            self.drawing_init()
+            lane.insert_car(self)
+            if self.engine:
+                self.engine.move(self)
 
         else:
             # don't change lanes
@@ -238,29 +214,23 @@ class Car:
         return can_change
 
 
-    def cross_junction(self):
+    def cross_junction(self, rng=random, routes=None):
         """
         pre: the next_junction property exists and is not None
+        Cars with a destination take the lane on their route given by the
+        routes LaneGraph, others (or if no lane leads there) pick one at random.
         """
         junction = self.lane.next_junction
 
         if self.lane in junction.lane_map:
-            new_lane = random.choice(junction.lane_map[self.lane])
+            new_lane = None
+            if routes is not None and self.destination is not None:
+                new_lane = routes.junction_lane(self.lane, self.destination)
+            if new_lane is None:
+                new_lane = rng.choice(junction.lane_map[self.lane])
             
             # Adjust the old lane
-            if self.trail_car:
-                self.trail_car.lead_car = None
-                self.trail_car = None
-            else:
-                self.lane.last_car = self.lead_car
-
-            del self.lane.cars[self.car_id]
-
-            # Adjust the new lane
-            if new_lane.last_car:
-                new_lane.last_car.trail_car = self
-                self.lead_car = new_lane.last_car
-                new_lane.last_car = self
+            self.lane.remove_car(self)
 
             # maintain position overflow
             # self.x = self.x - self.lane.length
@@ -268,54 +238,74 @@ class Car:
             # reset position
             self.x = 0
 
-            new_lane.cars[self.car_id] = self
+            # Adjust the new lane
             self.lane = new_lane
+            new_lane.insert_car(self)
+            if self.engine:
+                self.engine.move(self)
 
-            self.drawing_init()
 
+    def follow_route(self, routes, rng=random):
+        """
+        Change lanes if the route continues in a neighboring lane.
+        Returns False if the car needs to change lanes but cannot yet.
+        """
+        direction = routes.lane_change(self.lane, self.destination)
+        if not direction:
+            return True
+        return bool(self.change_lane(direction, rng=rng)) and routes.lane_change(self.lane, self.destination) is None
 
-    def update(self):
+
+    def update(self, dt=DT):
+        """
+        Advance the car by dt seconds. Returns False once the car passes the end of its lane.
+        """
         # check if there is a leading car
         if self.lead_car:
             # standard IDM model
             delta_v = self.lead_car.v - self.v
             s_star = self.s_0 + max(0, self.v*self.T + (self.v*delta_v)/(2*sqrt(self.a*self.b)))
             s = self.lead_car.x - self.x
-            dv = self.a*(1 - (self.v/self.v_0)**self.delta - (s_star/s)**2) if s != 0 else 0
+            # squared by multiplying, which saturates to inf at a vanishing gap where ** raises
+            ratio = s_star/s if s != 0 else 0
+            dv = self.a*(1 - (self.v/self.v_0)**self.delta - ratio*ratio) if s != 0 else 0
         else:
             # free road only
             dv = self.a*(1 - (self.v/self.v_0)**self.delta)
             
-        dt = 1
+        self.acc = dv
+
         v = self.v + dv*dt
-        x = self.x + self.v * dt + 0.5 * dv * dt * dt
+        if v < 0:
+            # the car comes to a stop within the step - stop there instead of rolling backwards
+            x = self.x - self.v * self.v / (2 * dv)
+        else:
+            x = self.x + self.v * dt + 0.5 * dv * dt * dt
 
         self.v = max(self.min_v, min(self.max_v, v))
         self.x = max(0, x)
 
-        self.t = self.x/self.lane.length
-
 
         return self.x < self.lane.length
 
 
 class CarGenerator:
     @staticmethod
-    def generate_car(random_init=True):
+    def generate_car(random_init=True, rng=random):
         if random_init:
 
             car_args = {
-                'v_0': random.gauss(V_0_MU, 1),
-                'T': random.gauss(T_MU, 0.5),
-                'b': random.gauss(B_MU, 1),
-                'a': random.gauss(A_MU, 0.5),
-                'v': random.gauss(V_MU, 0.1),
-                's_0': random.gauss(S_0_MU, 0.5),
-                'l': random.gauss(L_MU, 0.5),
-                'delta': random.gauss(DELTA_MU, 0.5)
+                'v_0': rng.gauss(V_0_MU, 1),
+                'T': max(T_MIN, rng.gauss(T_MU, 0.5)),
+                'b': rng.gauss(B_MU, 1),
+                'a': rng.gauss(A_MU, 0.5),
+                'v': rng.gauss(V_MU, 0.1),
+                's_0': rng.gauss(S_0_MU, 0.5),
+                'l': rng.gauss(L_MU, 0.5),
+                'delta': rng.gauss(DELTA_MU, 0.5)
             }
 
-            vehicle_f = random.choice([
+            vehicle_f = rng.choice([
                 CarGenerator.generate_sedan,
                 CarGenerator.generate_sports_car,
                 CarGenerator.generate_suv,
@@ -0,0 +1,137 @@
+"""
+Traffic demand: how many cars want to enter the network, where and when.
+
+A demand is a set of entry lanes, each with a piecewise-constant arrival rate
+in cars per hour:
+
+    {
+        "arrivals": "poisson",
+        "profiles": [
+            {"road": 0, "rates": [[0, 600], [300, 1800], [900, 600]]},
+            {"road": 3, "lane": 1, "rates": [[0, 400]]}
+        ]
+    }
+
+Rates hold from their start time (simulated seconds) until the next one. A
+profile without a lane is split evenly over the lanes of the road. Arrivals are
+Poisson, or deterministic with evenly spaced cars.
+
+All arrivals of a tick are drawn at once. Arriving cars join the entry queue
+of their lane and enter the network as soon as there is room at the start of
+the lane, see Simulation.release_entry_queues.
+"""
+from car import CarGenerator
+
+import numpy as np
+
+import json
+
+# cars/hour -> cars/second
+PER_HOUR = 1/3600
+
+
+class Demand:
+    """
+    Arrivals on entry lanes given as (road index, lane index), with rates[i, j]
+    cars/hour on entry i from times[i, j] seconds
+    """
+    def __init__(self, entries, times, rates, poisson=True, seed=None):
+        self.entries = [tuple(entry) for entry in entries]
+        self.times = np.asarray(times, dtype=float).reshape(len(self.entries), -1)
+        self.rates = np.asarray(rates, dtype=float).reshape(len(self.entries), -1) * PER_HOUR
+        self.poisson = poisson
+        self.rng = np.random.default_rng(seed)
+
+        # deterministic arrivals release a car each time the expected count passes a whole number
+        self.expected = np.zeros(len(self.entries))
+        # cars that arrived on every entry
+        self.arrived = np.zeros(len(self.entries), dtype=np.int64)
+
+
+    @classmethod
+    def from_profiles(cls, roads, profiles, poisson=True, seed=None):
+        """
+        Build a demand from profile dicts as in the module docstring, for a
+        network with the given roads
+        """
+        entries, profile_rates = [], []
+        for profile in profiles:
+            road = profile['road']
+            lanes = [profile['lane']] if 'lane' in profile else range(len(roads[road].lanes))
+            for lane in lanes:
+                entries.append((road, lane))
+                profile_rates.append([(t, rate/len(lanes)) for t, rate in profile['rates']])
+
+        # pad every profile to the same number of steps with rates that never start
+        steps = max((len(rates) for rates in profile_rates), default=0)
+        times = np.full((len(entries), steps), np.inf)
+        rates = np.zeros((len(entries), steps))
+        for i, profile in enumerate(profile_rates):
+            for j, (t, rate) in enumerate(sorted(profile)):
+                times[i, j], rates[i, j] = t, rate
+
+        return cls(entries, times, rates, poisson=poisson, seed=seed)
+
+
+    @classmethod
+    def uniform(cls, sim, rate, poisson=True, seed=None):
+        """
+        rate cars/hour onto every source road of a simulation
+        """
+        index = {road: i for i, road in enumerate(sim.roads)}
+        profiles = [{'road': index[road], 'rates': [(0, rate)]} for road in sim.road_ends]
+        return cls.from_profiles(sim.roads, profiles, poisson=poisson, seed=seed)
+
+
+    @classmethod
+    def load(cls, path, sim, seed=None):
+        with open(path) as f:
+            data = json.load(f)
+        return cls.from_profiles(sim.roads, data['profiles'], poisson=data.get('arrivals', 'poisson') == 'poisson',
+                                 seed=seed)
+
+
+    def rates_at(self, t):
+        """
+        Arrival rate of every entry at time t, in cars/second
+        """
+        step = (self.times <= t).sum(axis=1) - 1
+        return np.where(step >= 0, self.rates[np.arange(len(self.entries)), np.maximum(step, 0)], 0)
+
+
+    def arrivals(self, t, dt):
+        """
+        Number of cars arriving on every entry between t and t + dt
+        """
+        mean = self.rates_at(t) * dt
+        if self.poisson:
+            counts = self.rng.poisson(mean)
+        else:
+            self.expected += mean
+            # small tolerance so rounding does not hold back a car that is due
+            counts = np.floor(self.expected + 1e-9).astype(np.int64)
+            self.expected -= counts
+
+        self.arrived += counts
+        return counts
+
+
+    def update(self, sim, t):
+        """
+        Queue the cars arriving during the tick of sim from time t to t + sim.dt
+        """
+        counts = self.arrivals(t, sim.dt)
+        for i in np.flatnonzero(counts):
+            road, lane = self.entries[i]
+            lane = sim.roads[road].lanes[lane]
+            for _ in range(counts[i]):
+                sim.enqueue_car(CarGenerator.generate_car(rng=sim.rng), lane)
+
+
+    def stats(self, sim):
+        """
+        Arrivals and entry queue length of every entry
+        """
+        return [{'road': road, 'lane': lane, 'arrived': int(arrived),
+                 'queued': len(sim.entry_queues.get(sim.roads[road].lanes[lane], ()))}
+                for (road, lane), arrived in zip(self.entries, self.arrived)]
@@ -0,0 +1,200 @@
+import numpy as np
+
+
+class VectorEngine:
+    """
+    Struct-of-arrays stepping engine for the intelligent driver model.
+
+    Every car bound to the engine owns a slot in a set of contiguous arrays and
+    a single tick updates all of them at once. Cars keep their python objects
+    for the topology (lanes, junctions, lane changes), but their kinematic
+    state (x, v) is read from and written to the engine arrays.
+    """
+    # per-car parameters copied from the Car at bind time
+    PARAMS = ('v_0', 'T', 'a', 'b', 's_0', 'l', 'delta', 'max_v', 'min_v')
+
+    def __init__(self, capacity=1024):
+        self.capacity = 0
+        self.n_cars = 0
+
+        self.cars = []
+        self.free_slots = []
+
+        # lanes are mapped to integer ids so cars can be grouped per lane
+        self.lane_ids = {}
+        self.lanes = []
+        # lanes where a car passed its leader in the last step
+        self.passed_lanes = []
+        self.seq_counter = 0
+
+        self.resize(capacity)
+
+
+    def resize(self, capacity):
+        """
+        Grow all state arrays to hold at least capacity cars.
+        """
+        old = self.capacity
+        if capacity <= old:
+            return
+
+        def grow(arr, fill, dtype=np.float64):
+            new = np.full(capacity, fill, dtype=dtype)
+            if old:
+                new[:old] = arr
+            return new
+
+        self.x = grow(getattr(self, 'x', None), 0.0)
+        self.v = grow(getattr(self, 'v', None), 0.0)
+        self.acc = grow(getattr(self, 'acc', None), 0.0)
+        self.car_id = grow(getattr(self, 'car_id', None), -1, np.int64)
+        for param in self.PARAMS:
+            setattr(self, param, grow(getattr(self, param, None), 1.0))
+        self.length = grow(getattr(self, 'length', None), np.inf)
+
+        self.lane = grow(getattr(self, 'lane', None), -1, np.int64)
+        self.lead = grow(getattr(self, 'lead', None), -1, np.int64)
+        # order of entry into the current lane, used to break position ties
+        self.seq = grow(getattr(self, 'seq', None), 0, np.int64)
+        self.alive = grow(getattr(self, 'alive', None), False, bool)
+
+        self.cars.extend([None] * (capacity - old))
+        self.free_slots.extend(range(capacity-1, old-1, -1))
+        self.capacity = capacity
+
+
+    def lane_id(self, lane):
+        if lane not in self.lane_ids:
+            self.lane_ids[lane] = len(self.lane_ids)
+            self.lanes.append(lane)
+        return self.lane_ids[lane]
+
+
+    def add(self, car):
+        """
+        Bind a car to the engine, copying its state into a free slot.
+        """
+        if not self.free_slots:
+            self.resize(2*self.capacity)
+
+        slot = self.free_slots.pop()
+        self.x[slot] = car.x
+        self.v[slot] = car.v
+        self.acc[slot] = car.acc
+        self.car_id[slot] = car.car_id
+        for param in self.PARAMS:
+            getattr(self, param)[slot] = getattr(car, param)
+
+        self.alive[slot] = True
+        self.cars[slot] = car
+        self.n_cars += 1
+
+        car.engine = self
+        car.slot = slot
+        self.move(car)
+
+        return slot
+
+
+    def move(self, car):
+        """
+        Update the lane of a bound car after a lane change or junction crossing.
+        """
+        slot = car.slot
+        self.lane[slot] = self.lane_id(car.lane)
+        self.length[slot] = car.lane.length
+        self.seq[slot] = self.seq_counter
+        self.seq_counter += 1
+
+
+    def remove(self, car):
+        """
+        Unbind a car, handing its final state back to the object.
+        """
+        slot = car.slot
+        x, v, acc = float(self.x[slot]), float(self.v[slot]), float(self.acc[slot])
+
+        car.engine = None
+        car.slot = None
+        car.x, car.v, car.acc = x, v, acc
+
+        self.alive[slot] = False
+        self.lane[slot] = -1
+        self.cars[slot] = None
+        self.free_slots.append(slot)
+        self.n_cars -= 1
+
+
+    def compute_leads(self, idx):
+        """
+        Compute the slot of the car directly ahead of each active slot in its lane.
+        Cars are ordered by lane, then position, then latest entry last.
+        """
+        lead = np.full(len(idx), -1, dtype=np.int64)
+        if len(idx) < 2:
+            return lead
+
+        order = np.lexsort((-self.seq[idx], self.x[idx], self.lane[idx]))
+        lanes = self.lane[idx][order]
+        same_lane = lanes[:-1] == lanes[1:]
+
+        lead[order[:-1][same_lane]] = idx[order[1:][same_lane]]
+        return lead
+
+
+    def step(self, dt):
+        """
+        Advance every bound car by dt seconds.
+        Returns the cars that have reached the end of their lane.
+        """
+        idx = np.flatnonzero(self.alive)
+        self.passed_lanes = []
+        if not len(idx):
+            return []
+
+        lead = self.compute_leads(idx)
+        self.lead[idx] = lead
+
+        x, v = self.x[idx], self.v[idx]
+        v_0, T, a, b = self.v_0[idx], self.T[idx], self.a[idx], self.b[idx]
+        s_0, delta = self.s_0[idx], self.delta[idx]
+
+        # free road term
+        dv = 1 - (v/v_0)**delta
+
+        # interaction term for cars with a leading car
+        has_lead = lead >= 0
+        if has_lead.any():
+            lead_slots = lead[has_lead]
+            vf = v[has_lead]
+            delta_v = self.v[lead_slots] - vf
+            s_star = s_0[has_lead] + np.maximum(0, vf*T[has_lead] + (vf*delta_v)/(2*np.sqrt(a[has_lead]*b[has_lead])))
+            s = self.x[lead_slots] - x[has_lead]
+
+            blocked = s == 0
+            s[blocked] = 1
+            interaction = dv[has_lead] - (s_star/s)**2
+            interaction[blocked] = 0
+            dv[has_lead] = interaction
+
+        dv *= a
+        self.acc[idx] = dv
+
+        v_new = v + dv*dt
+        x_new = x + v*dt + 0.5*dv*dt*dt
+
+        # cars that come to a stop within the step stop there instead of rolling backwards
+        stopping = v_new < 0
+        if stopping.any():
+            x_new[stopping] = x[stopping] - v[stopping]**2/(2*dv[stopping])
+
+        self.v[idx] = np.clip(v_new, self.min_v[idx], self.max_v[idx])
+        self.x[idx] = np.maximum(0, x_new)
+
+        # lanes where a car passed the car ahead of it, whose order needs repairing
+        passed = np.zeros(len(idx), dtype=bool)
+        passed[has_lead] = self.x[idx[has_lead]] > self.x[lead[has_lead]]
+        self.passed_lanes = [self.lanes[i] for i in np.unique(self.lane[idx[passed]])]
+
+        finished = idx[self.x[idx] >= self.length[idx]]
+        return [self.cars[slot] for slot in finished]
@@ -0,0 +1,160 @@
+"""
+Monte Carlo ensemble runner.
+
+Runs R replicates of a scenario across a process pool. Every replicate gets its
+own random stream derived from the ensemble seed and its replicate index, so any
+replicate can be reproduced on its own and results do not depend on how the
+replicates are spread across workers.
+
+    python ensemble.py scen1 -r 200 -s 600 --seed 7 --out ensemble.json
+"""
+from headless import run
+from sim import Simulation, load_scenario
+from parameters import DT, GEOMETRY_CACHE_DIR
+
+import numpy as np
+
+import argparse
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# two-sided 95% normal quantile for confidence intervals
+Z_95 = 1.959963984540054
+
+
+def replicate_seed(seed, replicate):
+    """
+    Derive the seed of one replicate from the ensemble seed.
+    Streams of different replicates are statistically independent.
+    """
+    state = np.random.SeedSequence(seed, spawn_key=(replicate,)).generate_state(2, dtype=np.uint32)
+    return int(state[0]) << 32 | int(state[1])
+
+
+class RunningStats:
+    """
+    Streaming mean and variance of every numeric metric (Welford's algorithm)
+    """
+    def __init__(self):
+        self.n = {}
+        self.mean = {}
+        self.m2 = {}
+
+
+    def add(self, metrics):
+        for key, value in metrics.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+
+            n = self.n.get(key, 0) + 1
+            mean = self.mean.get(key, 0.0)
+            delta = value - mean
+            mean += delta / n
+
+            self.n[key] = n
+            self.mean[key] = mean
+            self.m2[key] = self.m2.get(key, 0.0) + delta * (value - mean)
+
+
+    def summary(self):
+        """
+        Mean, standard deviation and 95% confidence interval of each metric
+        """
+        summary = {}
+        for key, n in self.n.items():
+            mean = self.mean[key]
+            std = math.sqrt(self.m2[key] / (n - 1)) if n > 1 else 0.0
+            half_width = Z_95 * std / math.sqrt(n)
+            summary[key] = {
+                'n': n,
+                'mean': mean,
+                'std': std,
+                'ci95': (mean - half_width, mean + half_width),
+            }
+        return summary
+
+
+def run_replicate(scenario, replicate, seed, ticks=None, seconds=None, vectorized=False, dt=DT, substeps=1,
+                  geometry_cache=GEOMETRY_CACHE_DIR):
+    metrics = run(scenario, ticks=ticks, seconds=seconds, seed=replicate_seed(seed, replicate), vectorized=vectorized,
+                  dt=dt, substeps=substeps, geometry_cache=geometry_cache)
+    metrics['replicate'] = replicate
+    return metrics
+
+
+def iter_ensemble(scenario, replicates, seed=0, ticks=None, seconds=None, vectorized=False, dt=DT, substeps=1,
+                  workers=None, geometry_cache=GEOMETRY_CACHE_DIR):
+    """
+    Run the replicates across a process pool, yielding (metrics, stats) as each
+    replicate finishes, where stats aggregates every replicate finished so far.
+    Replicates sharing a geometry_cache directory build the road geometry once.
+    """
+    stats = RunningStats()
+
+    if geometry_cache:
+        # fill the cache once up front rather than in every worker at the same time
+        Simulation(scenario=load_scenario(scenario), geometry_cache=geometry_cache).add_roads()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_replicate, scenario, replicate, seed, ticks, seconds, vectorized, dt, substeps,
+                               geometry_cache)
+                   for replicate in range(replicates)]
+
+        for future in as_completed(futures):
+            metrics = future.result()
+            stats.add({key: value for key, value in metrics.items() if key not in ('seed', 'replicate', 'dt')})
+            yield metrics, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run replicates of a scenario in parallel and aggregate their metrics.')
+    parser.add_argument('scenario', nargs='?', default='scen4', help='scenario module in scenarios/')
+    parser.add_argument('-r', '--replicates', type=int, default=10)
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument('-n', '--ticks', type=int, help='number of ticks to simulate per replicate')
+    length.add_argument('-s', '--seconds', type=float, help='simulated seconds to run per replicate')
+    parser.add_argument('--seed', type=int, default=0, help='ensemble seed replicate streams are derived from')
+    parser.add_argument('-v', '--vectorized', action='store_true', help='step cars with the vectorized engine')
+    parser.add_argument('--dt', type=float, default=DT, help='simulated seconds per tick')
+    parser.add_argument('--substeps', type=int, default=1, help='integration steps per tick')
+    parser.add_argument('--geometry-cache', default=GEOMETRY_CACHE_DIR, metavar='DIR',
+                        help='read and save road geometry in this cache directory, shared by the workers')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('-o', '--out', help='write the replicates and summary to this JSON file')
+    args = parser.parse_args()
+
+    # one simulated minute by default
+    seconds = args.seconds if args.ticks is not None or args.seconds is not None else 60
+
+    results = []
+    stats = RunningStats()
+    for metrics, stats in iter_ensemble(args.scenario, args.replicates, seed=args.seed, ticks=args.ticks,
+                                        seconds=seconds, vectorized=args.vectorized, dt=args.dt,
+                                        substeps=args.substeps, workers=args.workers,
+                                        geometry_cache=args.geometry_cache):
+        results.append(metrics)
+        speed = stats.summary().get('mean_speed')
+        progress = f'{len(results)}/{args.replicates} replicates'
+        if speed:
+            low, high = speed['ci95']
+            progress += f', mean speed {speed["mean"]:.3f} m/s [{low:.3f}, {high:.3f}]'
+        print(progress, flush=True)
+
+    output = {
+        'scenario': args.scenario,
+        'seed': args.seed,
+        'replicates': sorted(results, key=lambda metrics: metrics['replicate']),
+        'summary': stats.summary(),
+    }
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output['summary'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+On-disk cache of road geometry.
+
+Building a network solves the splines of every lane and integrates their
+arc-lengths, and drawing or recording it builds an arc-length table per lane.
+None of that changes unless the roads do, so the results for a network are
+saved under a hash of its road definitions and the parameters that shape the
+lanes:
+
+    cache/
+        <key>/key_control_points.npy, lane_paths.npy, arc_points.npy, ...
+
+Later runs, and every process of a sweep sharing the directory, memory-map the
+arrays and build their roads from them without recomputing anything. Entries are
+written to a temporary directory and renamed into place, so processes racing to
+fill the same entry never see a partial one.
+"""
+from parameters import LANE_WIDTH, ARC_TABLE_SAMPLES, C_VALUES, T_VALUES
+from road import Road
+
+import numpy as np
+
+import hashlib
+import os
+import shutil
+
+
+GEOMETRY_FORMAT = 1
+
+# arrays of a cache entry, with the lanes of every road in the order they are built:
+# forward lanes, then backward lanes
+GEOMETRY_ARRAYS = (
+    'key_control_points', 'key_lengths',
+    'lane_paths', 'lane_control_points', 'lane_lengths',
+    'arc_steps', 'arc_offsets', 'arc_points', 'arc_tangents',
+)
+
+
+def geometry_key(network):
+    """
+    Hash of everything the geometry of a network depends on
+    """
+    h = hashlib.sha256()
+    h.update(repr((GEOMETRY_FORMAT, LANE_WIDTH, ARC_TABLE_SAMPLES, C_VALUES, T_VALUES)).encode())
+    for array in (network.points, network.offsets, network.n_lanes, network.one_way):
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+def built_lanes(road):
+    return road.forward_lanes + road.backward_lanes
+
+
+class GeometryCache:
+    """
+    Builds the roads of a Network from the cache in directory, computing and
+    saving their geometry on a miss
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+
+    def path(self, network):
+        return os.path.join(self.directory, geometry_key(network))
+
+
+    def load(self, network):
+        """
+        Memory-mapped arrays of the network's entry, or None if there is none
+        """
+        path = self.path(network)
+        if not os.path.isdir(path):
+            return None
+        # plain views of the mappings, which are much cheaper to slice into many small pieces
+        return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r').view(np.ndarray)
+                for name in GEOMETRY_ARRAYS}
+
+
+    def store(self, network, roads):
+        """
+        Save the geometry of built roads, building the arc-length table of every lane
+        """
+        lanes = [lane for road in roads for lane in built_lanes(road)]
+        tables = [lane.arc_table or lane.build_arc_table() for lane in lanes]
+
+        arrays = {
+            'key_control_points': np.concatenate([road.key_lane.control_points for road in roads]),
+            'key_lengths': np.array([road.key_lane.length for road in roads]),
+            'lane_paths': np.concatenate([lane.path for lane in lanes]),
+            'lane_control_points': np.concatenate([lane.control_points for lane in lanes]),
+            'lane_lengths': np.array([lane.length for lane in lanes]),
+            'arc_steps': np.array([step for step, _, _ in tables], dtype=float),
+            'arc_offsets': np.concatenate(([0], np.cumsum([len(points) for _, points, _ in tables]))),
+            'arc_points': np.concatenate([points for _, points, _ in tables]),
+            'arc_tangents': np.concatenate([tangents for _, _, tangents in tables]),
+        }
+
+        path = self.path(network)
+        tmp = f'{path}.tmp-{os.getpid()}'
+        os.makedirs(tmp, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), array)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+    def build_roads(self, network):
+        arrays = self.load(network)
+        if arrays is None:
+            self.misses += 1
+            roads = network.build_roads()
+            self.store(network, roads)
+            return roads
+
+        self.hits += 1
+        return self.roads_from_arrays(network, arrays)
+
+
+    @staticmethod
+    def roads_from_arrays(network, arrays):
+        """
+        Build the roads of a network from the arrays of its entry. As in
+        build_roads, roads with the same number of points and lanes are handled
+        together, gathering their rows of every array at once.
+        """
+        n_points = np.diff(network.offsets)
+        n_segments = n_points - 1
+        lane_counts = network.lane_counts
+
+        # first key segment, lane, lane point and lane segment of every road
+        def starts(counts):
+            return np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+        first_segment, first_lane = starts(n_segments), starts(lane_counts)
+        first_point, first_lane_segment = starts(lane_counts*n_points), starts(lane_counts*n_segments)
+
+        arc_steps = arrays['arc_steps'].tolist()
+        arc_offsets = arrays['arc_offsets'].tolist()
+        arc_points, arc_tangents = arrays['arc_points'], arrays['arc_tangents']
+
+        paths = network.paths()
+        groups = {}
+        for i, key in enumerate(zip(n_points.tolist(), network.n_lanes.tolist(), network.one_way.tolist())):
+            groups.setdefault(key, []).append(i)
+
+        roads = [None]*len(paths)
+        for (n, n_lanes, one_way), group in groups.items():
+            group = np.array(group)
+            count = int(lane_counts[group[0]])
+
+            key_control_points = arrays['key_control_points'][first_segment[group][:, None] + np.arange(n-1)]
+            key_lengths = arrays['key_lengths'][group].tolist()
+            lane_paths = arrays['lane_paths'][first_point[group][:, None] + np.arange(count*n)]
+            lane_paths = lane_paths.reshape(-1, count, n, 2)
+            lane_control_points = arrays['lane_control_points'][first_lane_segment[group][:, None] + np.arange(count*(n-1))]
+            lane_control_points = lane_control_points.reshape(-1, count, n-1, 4, 2)
+            lane_lengths = arrays['lane_lengths'][first_lane[group][:, None] + np.arange(count)]
+
+            for j, i in enumerate(group.tolist()):
+                geometry = key_control_points[j], key_lengths[j], lane_paths[j], lane_control_points[j], lane_lengths[j]
+                road = Road(paths[i], n_lanes=n_lanes, one_way=one_way, geometry=geometry)
+
+                # arc-length tables stay views of the mapping, read from disk only when used
+                for lane, built in enumerate(built_lanes(road), int(first_lane[i])):
+                    start, end = arc_offsets[lane], arc_offsets[lane+1]
+                    built.arc_table = (arc_steps[lane], arc_points[start:end], arc_tangents[start:end])
+                roads[i] = road
+
+        return roads
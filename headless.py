@@ -0,0 +1,453 @@
+"""
+Headless batch runner for the simulation core.
+
+Runs a scenario for a fixed number of ticks (or simulated seconds) with a fixed
+seed and reports summary metrics. Nothing here imports the GUI, so it can be
+used on machines without a display or dearpygui installed.
+
+    python headless.py scen4 --seconds 600 --seed 1 --out metrics.json
+"""
+from sim import Simulation, load_scenario
+from car import CarGenerator
+from network import Network
+from recorder import TrajectoryRecorder
+from demand import Demand
+from parameters import PPM, DT, IMPORT_TIME_BUDGET, GEOMETRY_CACHE_DIR, REBUILD_FRACTION
+
+import numpy as np
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+# modules that make up the simulation core and optional dependencies they must not pull in
+CORE_MODULES = ('sim', 'car', 'road', 'junction', 'bezier', 'math_functions', 'engine', 'lane_graph', 'network',
+                'geometry_cache', 'demand')
+OPTIONAL_MODULES = ('dearpygui', 'scipy')
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def bytes_per_car(n=1000, seed=0):
+    """
+    Memory allocated per car, measured with tracemalloc while spawning n cars onto
+    one lane without the engine: the car object and its entries in the simulation
+    and lane indexes
+    """
+    network = Network.from_roads([{'endpoints': [[0, 0], [1000, 0]], 'n_lanes': 1, 'one_way': True,
+                                   'is_source': True}])
+    sim = Simulation(scenario=network, seed=seed)
+    sim.add_roads()
+    lane = sim.roads[0].lanes[0]
+    car_args = [CarGenerator.generate_car(rng=sim.rng) for _ in range(n)]
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        for args in car_args:
+            sim.spawn_car(args, lane)
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+    return allocated / n
+
+
+def lane_positions(sim):
+    """
+    Map every lane to its position counted outwards from the center of its road,
+    so lanes at the same position on different roads are grouped together
+    """
+    return {lane: i for road in sim.roads
+            for lanes in (road.forward_lanes, road.backward_lanes)
+            for i, lane in enumerate(lanes)}
+
+
+def measure_import_time(modules=CORE_MODULES):
+    """
+    Import the modules in a fresh interpreter and return the time taken along with
+    any optional GUI or scientific modules that were imported on the way.
+    """
+    code = (
+        'import json, sys, time\n'
+        'start = time.perf_counter()\n'
+        f'import {", ".join(modules)}\n'
+        'elapsed = time.perf_counter() - start\n'
+        f'optional = [m for m in {OPTIONAL_MODULES!r} if m in sys.modules]\n'
+        'print(json.dumps({"seconds": elapsed, "optional_modules": optional}))\n'
+    )
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    return json.loads(result.stdout)
+
+
+def check_imports(budget=IMPORT_TIME_BUDGET):
+    """
+    Check the import time of the simulation core against the budget.
+    Returns the measurement with an 'ok' flag.
+    """
+    measurement = measure_import_time()
+    measurement['budget'] = budget
+    measurement['ok'] = measurement['seconds'] <= budget and not measurement['optional_modules']
+    return measurement
+
+
+def engine_states(sim, entered):
+    """
+    (road, lane, x, v, leader, crowded) of every car, keyed by its desired speed v_0
+    rather than its id, which depends on the order cars happened to enter. crowded
+    is whether the car is closer to its leader than its minimum spacing s_0. Records
+    the tick each car was first seen in entered.
+    """
+    lanes = {lane: (i, j) for i, road in enumerate(sim.roads) for j, lane in enumerate(road.lanes)}
+    states = {}
+    for car in sim.cars.values():
+        key = float(car.v_0)
+        entered.setdefault(key, sim.tick)
+        lead = car.lead_car
+        leader = float(lead.v_0) if lead else None
+        crowded = bool(lead) and lead.x - car.x < car.s_0
+        states[key] = (*lanes[car.lane], float(car.x), float(car.v), leader, crowded)
+    return states
+
+
+def check_engines(scenarios=('scen1', 'scen2', 'scen3', 'scen4'), seconds=120, seed=3, x_tolerance=5, v_tolerance=2):
+    """
+    Run every scenario with and without the vectorized engine on the same seed,
+    with random lane changes off, and compare every car after every tick.
+    The engine steps all cars from the same state while the object path updates
+    them one after another, so positions (pixels) and speeds (pixels/second) may
+    differ by up to x_tolerance and v_tolerance. Those small differences can tip a
+    spawn gap check or a junction crossing by a tick. Cars on different lanes for a
+    tick, cars that entered on different ticks and every car that has since
+    followed one of those are counted but not compared. Closer to its leader than
+    s_0, a car brakes so hard that a fraction of a pixel changes its speed a lot, so
+    the speeds of crowded cars are not compared either.
+    Returns the largest differences with an 'ok' flag.
+    """
+    results = {}
+    for scenario in scenarios:
+        sims = []
+        for vectorized in (False, True):
+            sim = Simulation(scenario=load_scenario(scenario), vectorized=vectorized, seed=seed)
+            sim.add_roads()
+            sim.lane_change_interval = math.inf
+            sims.append(sim)
+
+        entered = ({}, {})
+        # cars whose surroundings differ between the runs for reasons other than the integrator
+        diverged = set()
+        compared = skipped = crowded = 0
+        max_x = max_v = 0
+        for _ in range(int(round(seconds / sims[0].dt))):
+            for sim in sims:
+                sim.update()
+            objects, vectors = (engine_states(sim, cars) for sim, cars in zip(sims, entered))
+            both = objects.keys() & vectors.keys()
+            diverged.update(key for key in both if entered[0][key] != entered[1][key])
+            spreading = True
+            while spreading:
+                followers = {key for key in both if objects[key][4] in diverged} - diverged
+                diverged |= followers
+                spreading = bool(followers)
+
+            for key in both:
+                (road, lane, x, v, _, close), (other_road, other_lane, other_x, other_v, _, _) = objects[key], vectors[key]
+                if (road, lane) != (other_road, other_lane) or key in diverged:
+                    skipped += 1
+                    continue
+                compared += 1
+                max_x = max(max_x, abs(x - other_x))
+                if close:
+                    crowded += 1
+                else:
+                    max_v = max(max_v, abs(v - other_v))
+
+        results[scenario] = {'compared': compared, 'skipped': skipped, 'crowded': crowded,
+                             'max_x_difference': max_x, 'max_v_difference': max_v}
+
+    return {
+        'seed': seed,
+        'seconds': seconds,
+        'x_tolerance': x_tolerance,
+        'v_tolerance': v_tolerance,
+        'scenarios': results,
+        'ok': all(result['compared'] and result['max_x_difference'] <= x_tolerance
+                  and result['max_v_difference'] <= v_tolerance for result in results.values()),
+    }
+
+
+def route_ties(graph, tree, dist, next_lane, junction_lane, rtol=1e-9):
+    """
+    Compare a cached tree with fresh shortest paths. Equally short paths can be
+    found in either order, so a next lane or junction lane that differs from the
+    fresh one is accepted if it is just as short.
+    Returns the number of such ties, or None if the tree is wrong.
+    """
+    if not np.allclose(tree.dist, dist, rtol=rtol, atol=0):
+        return None
+
+    ends = tree.next_lane < 0
+    if np.any(ends != (next_lane < 0)):
+        return None
+
+    # cheapest edge between every pair of lanes, looked up by source*n + target
+    n = len(graph.lanes)
+    keys = graph.sources*n + graph.indices
+    order = np.lexsort((graph.weights, keys))
+    keys, weights = keys[order], graph.weights[order]
+
+    u = np.flatnonzero(~ends)
+    wanted = u*n + tree.next_lane[u]
+    e = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+    if np.any(keys[e] != wanted) or not np.allclose(dist[u], weights[e] + dist[tree.next_lane[u]], rtol=rtol, atol=0):
+        return None
+
+    picked = tree.junction_lane
+    if np.any((picked < 0) != (junction_lane < 0)):
+        return None
+    differs = np.flatnonzero(picked != junction_lane)
+    if not np.allclose(dist[picked[differs]], dist[junction_lane[differs]], rtol=rtol, atol=0):
+        return None
+
+    return int(np.count_nonzero(tree.next_lane != next_lane)) + len(differs)
+
+
+def check_routes(scenarios=('scen4', 'grid'), rounds=30, seed=0):
+    """
+    Apply random junction weight changes to the lane graph of every scenario and
+    check after each update_weights that every cached tree matches a fresh
+    shortest_paths. Rounds cycle through a few changed lanes with repairs forced,
+    every lane changed (which rebuilds the trees past REBUILD_FRACTION), and a few
+    changed lanes with the default fraction, which rebuilds on small networks.
+    Returns the counts with an 'ok' flag.
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    for scenario in scenarios:
+        sim = Simulation(scenario=load_scenario(scenario), seed=seed, routing=True)
+        sim.add_roads()
+        graph = sim.lane_graph
+        # keep a tree for every destination
+        graph.cache_size = len(graph.destinations)
+        for destination in graph.destinations:
+            graph.tree(destination)
+
+        # lanes with a junction ahead, the only ones whose cost is an edge weight
+        junction_lanes = np.unique(graph.sources[graph.junction_edges])
+        n = len(junction_lanes)
+        costs = graph.lengths.copy()
+        repaired = rebuilt = ties = wrong = 0
+        for i in range(rounds):
+            mode = i % 3
+            size = n if mode == 1 else rng.integers(1, max(1, n // 50), endpoint=True)
+            lanes = rng.choice(junction_lanes, size=size, replace=False)
+            # congested lanes cost up to a few times their length, and free up again
+            costs[lanes] = graph.lengths[lanes] * np.where(rng.random(len(lanes)) < 0.5, 1, rng.uniform(1, 4, len(lanes)))
+            fraction = math.inf if mode == 0 else REBUILD_FRACTION
+
+            changed = graph.changed_edges
+            graph.update_weights(costs, rebuild_fraction=fraction)
+            changed = graph.changed_edges - changed
+            if changed > fraction*len(graph.weights):
+                rebuilt += 1
+            elif changed:
+                repaired += 1
+
+            for destination, tree in graph.trees.items():
+                dist, next_lane = graph.shortest_paths(destination)
+                tied = route_ties(graph, tree, dist, next_lane, graph.best_junction_lanes(dist))
+                if tied is None:
+                    wrong += 1
+                else:
+                    ties += tied
+
+        results[scenario] = {'trees': len(graph.trees), 'repaired_rounds': repaired, 'rebuilt_rounds': rebuilt,
+                             'ties': ties, 'wrong_trees': wrong}
+
+    return {
+        'seed': seed,
+        'rounds': rounds,
+        'scenarios': results,
+        'ok': all(result['repaired_rounds'] and result['rebuilt_rounds'] and not result['wrong_trees']
+                  for result in results.values()),
+    }
+
+
+def run(scenario, ticks=None, seconds=None, seed=0, vectorized=False, dt=DT, substeps=1, sample_every=None,
+        record=None, record_every=1, routing=False, reroute=None, geometry_cache=GEOMETRY_CACHE_DIR,
+        demand=None, arrivals='poisson'):
+    """
+    Run a scenario headlessly and return a dict of summary metrics.
+    Speeds are sampled every sample_every ticks (one simulated second by default)
+    and reported in meters/second.
+    If record is a directory, the trajectories of every car are recorded there
+    every record_every ticks. With routing, reroute is the number of simulated
+    seconds between updates of the routes to the current congestion. Road geometry
+    is read from and saved to the cache in the geometry_cache directory, if given.
+    demand replaces the fixed spawn interval: either a rate in cars/hour onto every
+    source road, with 'poisson' or 'deterministic' arrivals, or the path of a JSON
+    demand file (see demand.py).
+    """
+    setup_start = time.perf_counter()
+    sim = Simulation(scenario=load_scenario(scenario), vectorized=vectorized, seed=seed, dt=dt, substeps=substeps,
+                     routing=routing, reroute_interval=reroute, geometry_cache=geometry_cache)
+    sim.add_roads()
+    if isinstance(demand, str) and demand.endswith('.json'):
+        sim.demand = Demand.load(demand, sim, seed=seed)
+    elif demand is not None:
+        sim.demand = Demand.uniform(sim, float(demand), poisson=arrivals == 'poisson', seed=seed)
+    setup = time.perf_counter() - setup_start
+
+    if record:
+        sim.recorder = TrajectoryRecorder(record, sim, every=record_every)
+
+    if ticks is None:
+        ticks = int(round((seconds or 0) / sim.dt))
+    if sample_every is None:
+        sample_every = max(1, int(round(1 / sim.dt)))
+
+    positions = lane_positions(sim)
+    n_positions = max(positions.values(), default=-1) + 1
+    speed_sums = [0]*n_positions
+    speed_counts = [0]*n_positions
+
+    car_ticks = 0
+
+    start = time.perf_counter()
+    for tick in range(1, ticks+1):
+        sim.update()
+        car_ticks += len(sim.cars)
+
+        if tick % sample_every == 0:
+            for car in sim.cars.values():
+                i = positions[car.lane]
+                speed_sums[i] += car.v
+                speed_counts[i] += 1
+
+    if sim.recorder:
+        sim.recorder.close()
+    wall = time.perf_counter() - start
+
+    # convert from pixels/second
+    to_mps = 1/PPM
+
+    metrics = {
+        'scenario': scenario,
+        'seed': seed,
+        'vectorized': vectorized,
+        'dt': sim.dt,
+        'ticks': ticks,
+        'sim_seconds': sim.time,
+        'setup_seconds': setup,
+        'wall_seconds': wall,
+        'ticks_per_second': ticks / wall if wall else None,
+        'cars_per_second': car_ticks / wall if wall else None,
+        'cars_spawned': sim.spawned_cars,
+        'cars_exited': sim.exited_cars,
+        'cars_live': len(sim.cars),
+        'cars_queued': sim.queued_cars,
+        'cars_dropped': sim.dropped_cars,
+        'mean_entry_delay': sim.entry_delay / sim.spawned_cars if sim.spawned_cars else None,
+        'mean_speed': float(sum(speed_sums) / sum(speed_counts) * to_mps) if sum(speed_counts) else None,
+        'peak_memory_mb': peak_memory_mb(),
+        'bytes_per_car': bytes_per_car(seed=seed),
+    }
+    if routing:
+        metrics['cars_arrived'] = sim.arrived_cars
+        metrics['cars_rerouted'] = sim.rerouted_cars
+        metrics['route_stats'] = sim.lane_graph.stats()
+    if sim.demand:
+        metrics['demand_arrivals'] = int(sim.demand.arrived.sum())
+    if sim.geometry_cache:
+        metrics['geometry_cache'] = 'hit' if sim.geometry_cache.hits else 'miss'
+    if sim.recorder:
+        metrics['recorded_rows'] = sum(chunk['rows'] for chunk in sim.recorder.chunks)
+    for i, (speed_sum, count) in enumerate(zip(speed_sums, speed_counts)):
+        metrics[f'lane_{i}_speed'] = float(speed_sum / count * to_mps) if count else None
+
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a scenario without the GUI and report summary metrics.')
+    parser.add_argument('scenario', nargs='?', default='scen4', help='scenario module in scenarios/')
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument('-n', '--ticks', type=int, help='number of ticks to simulate')
+    length.add_argument('-s', '--seconds', type=float, help='simulated seconds to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--vectorized', action='store_true', help='step cars with the vectorized engine')
+    parser.add_argument('--dt', type=float, default=DT, help='simulated seconds per tick')
+    parser.add_argument('--substeps', type=int, default=1, help='integration steps per tick')
+    parser.add_argument('--routing', action='store_true', help='give cars destinations and route them by shortest path')
+    parser.add_argument('--reroute', type=float, metavar='SECONDS',
+                        help='with --routing, update routes to the current congestion every SECONDS simulated seconds')
+    parser.add_argument('--geometry-cache', default=GEOMETRY_CACHE_DIR, metavar='DIR',
+                        help='read and save road geometry in this cache directory')
+    parser.add_argument('--demand', metavar='RATE|FILE',
+                        help='cars/hour entering every source road, or a JSON demand file, in place of the spawn interval')
+    parser.add_argument('--arrivals', choices=('poisson', 'deterministic'), default='poisson',
+                        help='arrival process for a --demand rate')
+    parser.add_argument('-o', '--out', help='write the metrics to this JSON file')
+    parser.add_argument('-r', '--record', help='record car trajectories to this directory')
+    parser.add_argument('--record-every', type=int, default=1, help='record every k-th tick')
+    parser.add_argument('--check-imports', action='store_true',
+                        help='check the import time of the simulation core against IMPORT_TIME_BUDGET and exit')
+    parser.add_argument('--check-engines', action='store_true',
+                        help='check that the vectorized engine and the per-car update agree on scen1-scen4 and exit')
+    parser.add_argument('--check-routes', action='store_true',
+                        help='check that repaired route trees match fresh shortest paths on scen4 and grid and exit')
+    args = parser.parse_args()
+
+    if args.check_engines:
+        result = check_engines()
+        print(json.dumps(result, indent=2))
+        sys.exit(0 if result['ok'] else 1)
+
+    if args.check_routes:
+        result = check_routes()
+        print(json.dumps(result, indent=2))
+        sys.exit(0 if result['ok'] else 1)
+
+    if args.check_imports:
+        measurement = check_imports()
+        print(json.dumps(measurement, indent=2))
+        sys.exit(0 if measurement['ok'] else 1)
+
+    # one simulated minute by default
+    seconds = args.seconds if args.ticks is not None or args.seconds is not None else 60
+
+    metrics = run(args.scenario, ticks=args.ticks, seconds=seconds, seed=args.seed, vectorized=args.vectorized,
+                  dt=args.dt, substeps=args.substeps, record=args.record, record_every=args.record_every,
+                  routing=args.routing, reroute=args.reroute, geometry_cache=args.geometry_cache,
+                  demand=args.demand, arrivals=args.arrivals)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(metrics, f, indent=2)
+    else:
+        print(json.dumps(metrics, indent=2))
+
+
+if __name__ == '__main__':
+    main()
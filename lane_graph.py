@@ -0,0 +1,424 @@
+"""
+Lane-level routing graph of a road network.
+
+Every lane is a node. A lane has a junction edge to each lane its junction
+feeds, weighted by the length of the lane, and a lane-change edge to each of
+its neighboring lanes, weighted by LANE_CHANGE_COST. Edges are stored in
+compressed sparse row form: the edges leaving lane u are
+indices/weights/kinds[indptr[u]:indptr[u+1]].
+
+Destinations are roads, reached by leaving the network through any lane of
+the road that has no junction ahead. Shortest-path trees towards a destination
+are computed once and cached, so picking the next lane at a junction is a
+single array lookup.
+
+Junction edge weights can follow congestion: update_weights takes per-lane
+costs, such as congestion_costs, which stretches the length of slow lanes by
+free-flow speed / measured speed, and repairs the cached trees in place, only
+revisiting the lanes whose shortest paths can change.
+"""
+from parameters import LANE_CHANGE_COST, ROUTE_CACHE_SIZE, V_0_MU, PPM, MIN_LINK_SPEED, REROUTE_TOLERANCE, REBUILD_FRACTION
+
+import numpy as np
+
+import heapq
+import time
+from collections import OrderedDict
+
+JUNCTION_EDGE = 0
+LANE_CHANGE_EDGE = 1
+
+
+class RouteTree:
+    """
+    Shortest paths from every lane to one destination.
+
+    dist: distance from the start of each lane to the destination (inf if unreachable)
+    next_lane: next lane on the shortest path, by junction or lane change (-1 at the destination)
+    junction_lane: best lane to take at the junction ahead of each lane (-1 if none reaches the destination)
+    """
+    def __init__(self, dist, next_lane, junction_lane):
+        self.dist = dist
+        self.next_lane = next_lane
+        self.junction_lane = junction_lane
+
+
+class LaneGraph:
+    def __init__(self, roads, lane_change_cost=LANE_CHANGE_COST, cache_size=ROUTE_CACHE_SIZE):
+        self.lanes = [lane for road in roads for lane in road.lanes]
+        self.index = {lane: i for i, lane in enumerate(self.lanes)}
+        self.lane_roads = np.array([i for i, road in enumerate(roads) for _ in road.lanes], dtype=np.int64)
+        self.lengths = np.array([lane.length for lane in self.lanes])
+        self.lane_change_cost = lane_change_cost
+
+        sources, targets, weights, kinds = [], [], [], []
+        for u, lane in enumerate(self.lanes):
+            junction = lane.next_junction
+            for next_lane in (junction.lane_map.get(lane, []) if junction else []):
+                if next_lane in self.index:
+                    sources.append(u)
+                    targets.append(self.index[next_lane])
+                    weights.append(lane.length)
+                    kinds.append(JUNCTION_EDGE)
+            for neighbor in (lane.left_lane, lane.right_lane):
+                if neighbor in self.index:
+                    sources.append(u)
+                    targets.append(self.index[neighbor])
+                    weights.append(lane_change_cost)
+                    kinds.append(LANE_CHANGE_EDGE)
+
+        n = len(self.lanes)
+        sources = np.array(sources, dtype=np.int64)
+        self.indptr, order = self.compress(sources, n)
+        self.indices = np.array(targets, dtype=np.int64)[order]
+        self.weights = np.array(weights, dtype=float)[order]
+        self.kinds = np.array(kinds, dtype=np.int8)[order]
+        self.sources = sources[order]
+
+        # transposed graph, searched backwards from the destinations
+        self.rev_indptr, self.rev_order = self.compress(self.indices, n)
+        self.rev_indices = self.sources[self.rev_order]
+        self.rev_weights = self.weights[self.rev_order]
+        self.lists = None
+
+        # lanes cars leave the network through, grouped by road
+        self.exits = {}
+        for u, lane in enumerate(self.lanes):
+            if lane.next_junction is None or not lane.next_junction.lane_map.get(lane):
+                self.exits.setdefault(int(self.lane_roads[u]), []).append(u)
+        self.destinations = sorted(self.exits)
+        self.exit_roads = np.full(n, -1, dtype=np.int64)
+        for road, exits in self.exits.items():
+            self.exit_roads[exits] = road
+        # destinations reachable from each lane cars have spawned on
+        self.reachable = {}
+
+        self.cache_size = cache_size
+        self.trees = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # junction edges and the lane they leave, for weight updates
+        self.junction_edges = np.flatnonzero(self.kinds == JUNCTION_EDGE)
+        self.weight_updates = 0
+        self.update_seconds = 0.0
+        self.max_update_seconds = 0.0
+        self.changed_edges = 0
+        self.repaired_trees = 0
+        self.repaired_lanes = 0
+        self.destination_lookups = 0
+        self.destination_seconds = 0.0
+        self.max_destination_seconds = 0.0
+
+
+    @staticmethod
+    def compress(sources, n):
+        """
+        Row pointers and the stable order that groups edges by source
+        """
+        order = np.argsort(sources, kind='stable')
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n), out=indptr[1:])
+        return indptr, order
+
+
+    def adjacency(self):
+        """
+        The forward and reverse CSR arrays as python lists, which are much faster
+        to index one element at a time in the search loops
+        """
+        if self.lists is None:
+            self.lists = (self.indptr.tolist(), self.indices.tolist(), self.weights.tolist(),
+                          self.rev_indptr.tolist(), self.rev_indices.tolist(), self.rev_weights.tolist())
+        return self.lists
+
+
+    def shortest_paths(self, destination):
+        """
+        Dijkstra's algorithm over the reversed edges from the exits of the destination road
+        """
+        n = len(self.lanes)
+        dist = [np.inf]*n
+        next_lane = [-1]*n
+
+        heap = []
+        for u in self.exits.get(destination, []):
+            dist[u] = 0
+            heap.append((0.0, u))
+        heapq.heapify(heap)
+
+        self.propagate(heap, dist, next_lane)
+
+        return np.array(dist), np.array(next_lane, dtype=np.int64)
+
+
+    def propagate(self, heap, dist, next_lane):
+        """
+        Settle the lanes on the heap and relax the edges into them until no distance improves
+        """
+        _, _, _, rev_indptr, rev_indices, rev_weights = self.adjacency()
+        updated = 0
+        while heap:
+            d, v = heapq.heappop(heap)
+            if d > dist[v]:
+                continue
+            for e in range(rev_indptr[v], rev_indptr[v+1]):
+                u = rev_indices[e]
+                du = d + rev_weights[e]
+                if du < dist[u]:
+                    dist[u] = du
+                    next_lane[u] = v
+                    heapq.heappush(heap, (du, u))
+                    updated += 1
+        return updated
+
+
+    def best_junction_lanes(self, dist):
+        """
+        Best junction edge out of every lane given the distances of a tree
+        """
+        junction = self.junction_edges
+        sources, targets = self.sources[junction], self.indices[junction]
+        cost = dist[targets]
+        # sort by lane, then cost, so the first edge of each lane is its best
+        order = np.lexsort((cost, sources))
+        sources, targets, cost = sources[order], targets[order], cost[order]
+        first = np.r_[True, sources[1:] != sources[:-1]] & np.isfinite(cost)
+
+        junction_lane = np.full(len(self.lanes), -1, dtype=np.int64)
+        junction_lane[sources[first]] = targets[first]
+        return junction_lane
+
+
+    def build_tree(self, destination):
+        dist, next_lane = self.shortest_paths(destination)
+        return RouteTree(dist, next_lane, self.best_junction_lanes(dist))
+
+
+    def repair_tree(self, tree, edges, old_weights):
+        """
+        Update a tree after the weights of edges changed from old_weights.
+        Lanes whose path used an edge that got longer are cut from the tree with
+        everything routed through them and reconnected from their neighbors;
+        edges that got shorter seed improvements, which are then propagated
+        backwards as in Dijkstra's algorithm.
+        Returns the number of lanes whose distance was recomputed or improved.
+        """
+        indptr, indices, weights, rev_indptr, rev_indices, _ = self.adjacency()
+        dist, next_lane = tree.dist.tolist(), tree.next_lane.tolist()
+
+        changed = zip(self.sources[edges].tolist(), self.indices[edges].tolist(),
+                      self.weights[edges].tolist(), old_weights.tolist())
+        increased, decreased = [], []
+        for edge in changed:
+            (increased if edge[2] > edge[3] else decreased).append(edge)
+
+        # lanes routed over an edge that got longer, and every lane routed through them
+        affected = {u for u, v, _, _ in increased if next_lane[u] == v}
+        stack = list(affected)
+        while stack:
+            v = stack.pop()
+            for e in range(rev_indptr[v], rev_indptr[v+1]):
+                u = rev_indices[e]
+                if next_lane[u] == v and u not in affected:
+                    affected.add(u)
+                    stack.append(u)
+
+        for u in affected:
+            dist[u] = np.inf
+            next_lane[u] = -1
+
+        # reconnect the cut lanes from the lanes that kept their distances
+        heap = []
+        for u in affected:
+            for e in range(indptr[u], indptr[u+1]):
+                d = weights[e] + dist[indices[e]]
+                if d < dist[u]:
+                    dist[u] = d
+                    next_lane[u] = indices[e]
+            if dist[u] < np.inf:
+                heap.append((dist[u], u))
+
+        # edges that got shorter
+        for u, v, w, _ in decreased:
+            d = w + dist[v]
+            if d < dist[u]:
+                dist[u] = d
+                next_lane[u] = v
+                heap.append((d, u))
+
+        heapq.heapify(heap)
+        updated = len(affected) + self.propagate(heap, dist, next_lane)
+
+        tree.dist = np.array(dist)
+        tree.next_lane = np.array(next_lane, dtype=np.int64)
+        tree.junction_lane = self.best_junction_lanes(tree.dist)
+        return updated
+
+
+    def update_weights(self, lane_costs, tolerance=REROUTE_TOLERANCE, rebuild_fraction=REBUILD_FRACTION):
+        """
+        Set the cost of leaving every lane by a junction to lane_costs and repair
+        the cached trees. Weights within tolerance (relative) of their current
+        value are left alone. When more than rebuild_fraction of the edges change,
+        the trees are rebuilt instead. Returns the trees that were repaired.
+        """
+        start = time.perf_counter()
+
+        edges = self.junction_edges
+        new = np.asarray(lane_costs, dtype=float)[self.sources[edges]]
+        old = self.weights[edges]
+        changed = np.abs(new - old) > tolerance*old
+        edges, new, old = edges[changed], new[changed], old[changed]
+
+        repaired = []
+        if len(edges):
+            self.weights[edges] = new
+            # keep the transposed copy in step
+            self.rev_weights = self.weights[self.rev_order]
+            self.lists = None
+
+            # past a point, searching from scratch is cheaper than working out what changed
+            rebuild = len(edges) > rebuild_fraction*len(self.weights)
+            for destination, tree in self.trees.items():
+                if rebuild:
+                    tree.dist, tree.next_lane = self.shortest_paths(destination)
+                    tree.junction_lane = self.best_junction_lanes(tree.dist)
+                    self.repaired_lanes += len(self.lanes)
+                    repaired.append(destination)
+                    continue
+
+                sources, targets = self.sources[edges], self.indices[edges]
+                d_new = new + tree.dist[targets]
+                # a tree is touched by a tree edge that got longer or any edge that now gives a shorter path
+                touched = ((new > old) & (tree.next_lane[sources] == targets)) | (d_new < tree.dist[sources])
+                if touched.any():
+                    self.repaired_lanes += self.repair_tree(tree, edges, old)
+                    repaired.append(destination)
+
+        elapsed = time.perf_counter() - start
+        self.weight_updates += 1
+        self.update_seconds += elapsed
+        self.max_update_seconds = max(self.max_update_seconds, elapsed)
+        self.changed_edges += len(edges)
+        self.repaired_trees += len(repaired)
+
+        return repaired
+
+
+    def tree(self, destination):
+        """
+        Shortest-path tree to a destination road, from the cache if possible
+        """
+        tree = self.trees.get(destination)
+        if tree is not None:
+            self.hits += 1
+            self.trees.move_to_end(destination)
+            return tree
+
+        self.misses += 1
+        tree = self.build_tree(destination)
+        self.trees[destination] = tree
+        if len(self.trees) > self.cache_size:
+            self.trees.popitem(last=False)
+        return tree
+
+
+    def reachable_destinations(self, lane):
+        """
+        Destination roads that can be reached from a lane, other than its own road.
+        Found by a search forward from the lane rather than a tree per destination,
+        which would thrash the route cache on networks with many destinations.
+        """
+        start = time.perf_counter()
+        u = self.index[lane]
+        if u not in self.reachable:
+            indptr, indices = self.adjacency()[:2]
+            seen = {u}
+            stack = [u]
+            while stack:
+                v = stack.pop()
+                for w in indices[indptr[v]:indptr[v + 1]]:
+                    if w not in seen:
+                        seen.add(w)
+                        stack.append(w)
+            road = self.lane_roads[u]
+            reached = set(self.exit_roads[list(seen)].tolist())
+            self.reachable[u] = [d for d in self.destinations if d != road and d in reached]
+
+        elapsed = time.perf_counter() - start
+        self.destination_lookups += 1
+        self.destination_seconds += elapsed
+        self.max_destination_seconds = max(self.max_destination_seconds, elapsed)
+        return self.reachable[u]
+
+
+    def junction_lane(self, lane, destination):
+        """
+        The lane to take at the junction ahead of lane, or None if no lane there leads to the destination
+        """
+        v = self.tree(destination).junction_lane[self.index[lane]]
+        return self.lanes[v] if v >= 0 else None
+
+
+    def route_step(self, lane, destination):
+        """
+        (next lane, junction lane) indices of lane on the cached tree to destination,
+        or None if that tree is not cached. Does not build trees or touch the cache.
+        """
+        tree = self.trees.get(destination)
+        if tree is None:
+            return None
+        u = self.index[lane]
+        return int(tree.next_lane[u]), int(tree.junction_lane[u])
+
+
+    def lane_change(self, lane, destination):
+        """
+        'L' or 'R' if the shortest path continues in a neighboring lane, otherwise None
+        """
+        v = self.tree(destination).next_lane[self.index[lane]]
+        if v < 0:
+            return None
+
+        next_lane = self.lanes[v]
+        if next_lane is lane.left_lane:
+            return 'L'
+        if next_lane is lane.right_lane:
+            return 'R'
+        return None
+
+
+    def stats(self):
+        return {
+            'lanes': len(self.lanes),
+            'edges': len(self.indices),
+            'trees': len(self.trees),
+            'hits': self.hits,
+            'misses': self.misses,
+            'weight_updates': self.weight_updates,
+            'changed_edges': self.changed_edges,
+            'repaired_trees': self.repaired_trees,
+            'repaired_lanes': self.repaired_lanes,
+            'mean_update_seconds': self.update_seconds / self.weight_updates if self.weight_updates else None,
+            'max_update_seconds': self.max_update_seconds,
+            'mean_destination_seconds': (self.destination_seconds / self.destination_lookups
+                                         if self.destination_lookups else None),
+            'max_destination_seconds': self.max_destination_seconds,
+        }
+
+
+def congestion_costs(lanes, free_speed=V_0_MU*PPM, min_speed=MIN_LINK_SPEED):
+    """
+    Length of every lane stretched by free-flow speed / mean speed of the cars on
+    it, i.e. its current travel time expressed as a free-flow distance.
+    Empty lanes cost their length.
+    """
+    costs = np.empty(len(lanes))
+    for i, lane in enumerate(lanes):
+        if lane.cars:
+            speed = sum(car.v for car in lane.cars.values()) / len(lane.cars)
+            costs[i] = lane.length * free_speed / min(free_speed, max(min_speed, speed))
+        else:
+            costs[i] = lane.length
+    return costs
@@ -84,38 +84,62 @@ def make_141_matrix(n):
 
 
 def make_spline_const_matrix(path):
-    x, y = [list(p) for p in zip(*path)] # unzip list of tuples
+    """
+    Right-hand side of the spline system for a path of shape (..., n, 2)
+    """
+    path = np.asarray(path, dtype=float)
 
-    m = len(path)-2
+    C = 6*path[..., 1:-1, :]
 
-    C = np.zeros((2, m)) # transpose later
+    # set the 4 edge values
+    C[..., 0, :] -= path[..., 0, :]
+    C[..., -1, :] -= path[..., -1, :]
 
-    Cx = [6*v for v in x[1:-1]]
-    Cy = [6*v for v in y[1:-1]]
+    return C
 
-    # set the 4 edge values
-    Cx[0] -= x[0]
-    Cx[-1] -= x[-1]
-    Cy[0] -= y[0]
-    Cy[-1] -= y[-1]
 
-    C = np.array([Cx, Cy]).T
+def solve_141_system(C):
+    """
+    Solve M B = C where M is the (n-2)x(n-2) tridiagonal matrix from make_141_matrix,
+    using the Thomas algorithm in O(n) time and memory.
+    C has shape (..., m, d) so the x and y coordinates of several paths are solved together.
+    """
+    C = np.asarray(C, dtype=float)
+    m = C.shape[-2]
 
-    return C
+    # forward sweep - the modified super-diagonal is the same for every right-hand side
+    c = np.empty(m)
+    D = np.empty_like(C)
+    c[0] = 1/4
+    D[..., 0, :] = C[..., 0, :]/4
+    for i in range(1, m):
+        denom = 4 - c[i-1]
+        c[i] = 1/denom
+        D[..., i, :] = (C[..., i, :] - D[..., i-1, :])/denom
+
+    # back substitution
+    B = D
+    for i in range(m-2, -1, -1):
+        B[..., i, :] -= c[i]*B[..., i+1, :]
+
+    return B
 
 
 def cubic_spline_interpolation(path):
+    """
+    Compute the B-spline control points of a path of shape (n, 2), or of several
+    paths with the same number of points stacked as (k, n, 2)
+    """
     # S_i = 1/6 B_{i-1} + 2/3 B_i + 1/6 B_{i+1}
     # where S_i is point i of the path
-    M = make_141_matrix(len(path))
-    M_inv = np.linalg.inv(M)
+    path = np.asarray(path, dtype=float)
 
     C = make_spline_const_matrix(path)
 
-    B_star = np.matmul(M_inv, C)
+    B_star = solve_141_system(C)
 
     # add the edge points S_0 and S_n
-    B_star = np.concatenate((np.array([path[0]]), B_star, np.array([path[-1]])))
+    B_star = np.concatenate((path[..., :1, :], B_star, path[..., -1:, :]), axis=-2)
 
     return B_star
 
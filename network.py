@@ -0,0 +1,338 @@
+"""
+Declarative road networks.
+
+A network is a list of roads and the junction links between their lanes. It can
+be written by hand as JSON:
+
+    {
+        "roads": [
+            {"endpoints": [[100, 500], [490, 500]], "n_lanes": 3, "one_way": false, "is_source": true},
+            {"endpoints": [[520, 500], [900, 500]], "n_lanes": 2}
+        ],
+        "links": [[0, 0, 1, 0], [0, 1, 1, 1]]
+    }
+
+Roads take the keys of the dict form of scenario modules. A link
+[out_road, out_lane, in_road, in_lane] lets cars leaving the end of a lane continue
+into another, with lanes numbered as in Road.lanes, the same as the 'out.lane-in.lane'
+strings of a scenario road_map.
+
+Networks compile to .npz files of flat arrays: the points of every road one after
+another with the offset of each road, the lane counts and flags of the roads and an
+(n, 4) array of links. They load with a few bulk reads, and the roads are built
+with build_roads.
+
+Every network is checked as a whole when it is made, and all problems are reported
+together in a single NetworkError.
+
+    python network.py scen4 -o scen4.npz
+"""
+from road import build_roads
+
+import numpy as np
+
+import argparse
+import importlib
+import json
+import os
+import sys
+
+
+NETWORK_FORMAT = 1
+
+# arrays of a compiled network
+NETWORK_ARRAYS = ('points', 'offsets', 'n_lanes', 'one_way', 'is_source', 'links')
+
+
+class NetworkError(ValueError):
+    """
+    A network with problems; errors lists every one of them
+    """
+    def __init__(self, errors, name=None):
+        self.errors = list(errors)
+        where = f' in {name}' if name else ''
+        super().__init__(f'{len(self.errors)} error(s){where}:\n' + '\n'.join(f'  {error}' for error in self.errors))
+
+
+def road_definition(road):
+    """
+    Normalize a scenario road to the dict form of network files.
+    Older scenarios list a road as a path of points, or as a list of
+    (start, end) segments which are joined into a single path.
+    """
+    if isinstance(road, dict):
+        return road
+
+    if isinstance(road[0][0], (int, float)):
+        path = road
+    else:
+        path = [pt for segment in road for pt in segment]
+
+    return {'endpoints': path, 'n_lanes': 3, 'is_source': True}
+
+
+def parse_link(road_string):
+    """
+    Parse an 'out_road.out_lane-in_road.in_lane' road map string
+    """
+    ends = road_string.split('-')
+    if len(ends) != 2:
+        raise ValueError(f"expected 'out_road.out_lane-in_road.in_lane', got {road_string!r}")
+
+    link = []
+    for end in ends:
+        parts = end.split('.')
+        if len(parts) != 2:
+            raise ValueError(f"expected 'road.lane', got {end!r} in {road_string!r}")
+        link.extend(int(part) for part in parts)
+    return link
+
+
+def link_name(link):
+    out_road, out_lane, in_road, in_lane = link
+    return f'{out_road}.{out_lane}-{in_road}.{in_lane}'
+
+
+class Network:
+    """
+    Roads and junction links of a network as flat arrays. The key path of road i
+    is points[offsets[i]:offsets[i+1]].
+    """
+    def __init__(self, points, offsets, n_lanes, one_way, is_source, links, name=None):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.n_lanes = np.asarray(n_lanes, dtype=np.int32)
+        self.one_way = np.asarray(one_way, dtype=bool)
+        self.is_source = np.asarray(is_source, dtype=bool)
+        self.links = np.asarray(links, dtype=np.int64).reshape(-1, 4)
+        self.name = name
+
+
+    def __len__(self):
+        return len(self.n_lanes)
+
+
+    @property
+    def lane_counts(self):
+        # two-way roads have n_lanes in each direction
+        return self.n_lanes * np.where(self.one_way, 1, 2)
+
+
+    def paths(self):
+        return np.split(self.points, self.offsets[1:-1])
+
+
+    def validate(self, skip=()):
+        """
+        Check the whole network at once and return a list of every problem found.
+        Roads in skip were already found to be malformed and are not checked again.
+        """
+        errors = []
+        n_roads = len(self)
+        checked = np.ones(n_roads, dtype=bool)
+        checked[list(skip)] = False
+
+        if not n_roads:
+            errors.append('the network has no roads')
+        elif not self.is_source.any():
+            errors.append('no road is a source, so no car can enter the network')
+
+        # per-road geometry
+        n_points = np.diff(self.offsets)
+        road_of_point = np.repeat(np.arange(n_roads), n_points)
+        finite = np.isfinite(self.points).all(axis=1)
+        bad_points = np.zeros(n_roads, dtype=bool)
+        bad_points[road_of_point[~finite]] = True
+        # consecutive points of the same road that coincide make a segment without direction
+        repeated = np.zeros(n_roads, dtype=bool)
+        same = (np.diff(self.points, axis=0) == 0).all(axis=1) & (road_of_point[1:] == road_of_point[:-1])
+        repeated[road_of_point[1:][same]] = True
+
+        for road in np.flatnonzero(checked & (n_points < 2)):
+            errors.append(f'road {road}: needs at least 2 points, has {n_points[road]}')
+        for road in np.flatnonzero(checked & bad_points):
+            errors.append(f'road {road}: has coordinates that are not finite')
+        for road in np.flatnonzero(checked & repeated):
+            errors.append(f'road {road}: repeats a point')
+        for road in np.flatnonzero(checked & (self.n_lanes < 1)):
+            errors.append(f'road {road}: needs at least 1 lane, has {self.n_lanes[road]}')
+
+        # links
+        links = self.links
+        lane_counts = self.lane_counts
+        valid = np.ones(len(links), dtype=bool)
+        for side, (road_col, lane_col) in (('from', (0, 1)), ('into', (2, 3))):
+            roads, lanes = links[:, road_col], links[:, lane_col]
+            exists = (roads >= 0) & (roads < n_roads)
+            for k in np.flatnonzero(~exists):
+                errors.append(f'link {link_name(links[k])}: links {side} road {roads[k]}, which does not exist')
+
+            in_range = exists.copy()
+            if n_roads:
+                known = np.where(exists, roads, 0)
+                in_range &= (lanes >= 0) & (lanes < lane_counts[known])
+                for k in np.flatnonzero(exists & ~in_range & checked[known]):
+                    errors.append(f'link {link_name(links[k])}: links {side} lane {lanes[k]} of road {roads[k]}, '
+                                  f'which has {lane_counts[roads[k]]} lane(s)')
+            valid &= in_range
+
+        if len(links):
+            _, first, counts = np.unique(links, axis=0, return_index=True, return_counts=True)
+            for k in first[counts > 1]:
+                errors.append(f'link {link_name(links[k])}: given {counts[first == k][0]} times')
+
+        # roads no car can get onto, i.e. lanes that dangle from nothing
+        reached = self.is_source.copy()
+        reached[links[valid, 2]] = True
+        for road in np.flatnonzero(checked & ~reached):
+            errors.append(f'road {road}: is not a source and no lane links into it, so no car can reach it')
+
+        return errors
+
+
+    def check(self, errors=(), skip=()):
+        """
+        Raise a NetworkError with errors and every problem found by validate, if any
+        """
+        errors = list(errors) + self.validate(skip)
+        if errors:
+            raise NetworkError(errors, self.name)
+        return self
+
+
+    @classmethod
+    def from_roads(cls, roads, links=(), name=None):
+        """
+        Compile road definitions in the dict form of scenario modules and
+        [out_road, out_lane, in_road, in_lane] links
+        """
+        errors = []
+        malformed = []
+        paths, n_lanes, one_way, is_source = [], [], [], []
+
+        for i, road in enumerate(roads):
+            try:
+                if not isinstance(road, dict):
+                    raise ValueError('expected a dict with endpoints')
+                path = np.asarray(road['endpoints'], dtype=np.float64)
+                if path.ndim != 2 or path.shape[1] != 2:
+                    raise ValueError(f'endpoints must be a list of (x, y) points, got shape {path.shape}')
+                lanes = road.get('n_lanes', 3)
+                if isinstance(lanes, bool) or not isinstance(lanes, (int, np.integer)):
+                    raise ValueError(f'n_lanes must be an integer, got {lanes!r}')
+            except KeyError as e:
+                errors.append(f'road {i}: missing {e}')
+            except (ValueError, TypeError) as e:
+                errors.append(f'road {i}: {e}')
+            else:
+                paths.append(path)
+                n_lanes.append(lanes)
+                one_way.append(bool(road.get('one_way', False)))
+                is_source.append(bool(road.get('is_source', False)))
+                continue
+
+            # keep the numbering of the other roads for the checks that follow
+            malformed.append(i)
+            paths.append(np.zeros((0, 2)))
+            n_lanes.append(0)
+            one_way.append(False)
+            is_source.append(False)
+
+        link_rows = []
+        for k, link in enumerate(links):
+            try:
+                row = parse_link(link) if isinstance(link, str) else [int(x) for x in link]
+                if len(row) != 4:
+                    raise ValueError(f'expected [out_road, out_lane, in_road, in_lane], got {link!r}')
+            except (ValueError, TypeError) as e:
+                errors.append(f'link {k}: {e}')
+            else:
+                link_rows.append(row)
+
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(path) for path in paths])
+        points = np.concatenate(paths) if paths else np.zeros((0, 2))
+
+        network = cls(points, offsets, n_lanes, one_way, is_source, link_rows, name=name)
+        return network.check(errors, skip=malformed)
+
+
+    @classmethod
+    def from_dict(cls, data, name=None):
+        return cls.from_roads(data.get('roads', []), data.get('links', []), name=name)
+
+
+    @classmethod
+    def from_scenario(cls, scenario):
+        """
+        Compile a scenario module with roads and an optional road_map
+        """
+        name = getattr(scenario, '__name__', None)
+        roads = [road_definition(road) for road in scenario.roads]
+        return cls.from_roads(roads, getattr(scenario, 'road_map', None) or [], name=name)
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a .json network file or a compiled .npz network
+        """
+        if path.endswith('.npz'):
+            with np.load(path, allow_pickle=False) as data:
+                if int(data['format']) != NETWORK_FORMAT:
+                    raise NetworkError([f'compiled with network format {int(data["format"])}, '
+                                        f'expected {NETWORK_FORMAT}'], path)
+                arrays = {name: data[name] for name in NETWORK_ARRAYS}
+            return cls(**arrays, name=path).check()
+
+        with open(path) as f:
+            return cls.from_dict(json.load(f), name=path)
+
+
+    def to_dict(self):
+        return {
+            'roads': [{'endpoints': path.tolist(), 'n_lanes': int(n_lanes), 'one_way': bool(one_way),
+                       'is_source': bool(is_source)}
+                      for path, n_lanes, one_way, is_source in zip(self.paths(), self.n_lanes, self.one_way, self.is_source)],
+            'links': self.links.tolist(),
+        }
+
+
+    def save(self, path):
+        """
+        Write the network as JSON, or compiled if path ends in .npz
+        """
+        if path.endswith('.npz'):
+            np.savez(path, format=NETWORK_FORMAT, **{name: getattr(self, name) for name in NETWORK_ARRAYS})
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.to_dict(), f)
+
+
+    def build_roads(self):
+        return build_roads(self.paths(), self.n_lanes.tolist(), self.one_way.tolist())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a network and convert it between scenario, JSON and compiled forms.')
+    parser.add_argument('network', help='scenario module in scenarios/, or a .json or .npz network file')
+    parser.add_argument('-o', '--out', help='write the network to this .json or .npz file')
+    args = parser.parse_args()
+
+    try:
+        if args.network.endswith(('.json', '.npz')):
+            network = Network.load(args.network)
+        else:
+            network = Network.from_scenario(importlib.import_module(f'scenarios.{args.network}'))
+    except NetworkError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    print(f'{len(network)} roads, {int(network.lane_counts.sum())} lanes, {len(network.links)} links: ok')
+    if args.out:
+        network.save(args.out)
+        print(f'wrote {os.path.abspath(args.out)}')
+
+
+if __name__ == '__main__':
+    main()
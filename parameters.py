@@ -3,13 +3,58 @@ CANVAS_WIDTH = 1800
 DEFAULT_PADDING = 3
 FONT_SIZE = 13
 BEZIER_COLORS = [(200, 50, 50, 100), (50, 200, 50, 100), (50, 50, 200, 100)]
+# refresh rate of the logging panel (updates per second)
+LOG_RATE = 4
+# rows of the lane table in the logging panel, the rest are paged through
+LANE_TABLE_ROWS = 20
 
 LANE_WIDTH = 8
 
+# cell size of the spatial index used to cull lanes and cars outside the view (pixels)
+GRID_CELL_SIZE = 256
+
+# samples per Bezier segment in a lane's arc-length lookup table
+ARC_TABLE_SAMPLES = 64
+
+# directory of the on-disk road geometry cache, or None to build the geometry on every run
+GEOMETRY_CACHE_DIR = None
+
+# memory bound for the shared Bezier look-up table cache
+LUT_CACHE_BYTES = 16 * 2**20
+
+# routing: cost of a lane change in a route (pixels of driving) and number of cached shortest-path trees
+LANE_CHANGE_COST = 50
+ROUTE_CACHE_SIZE = 256
+# dynamic rerouting: link speeds are floored at MIN_LINK_SPEED (pixels/second) and
+# edge weights changing by less than REROUTE_TOLERANCE (relative) are not updated;
+# trees are rebuilt rather than repaired when more than REBUILD_FRACTION of the edges change
+MIN_LINK_SPEED = 1
+REROUTE_TOLERANCE = 0.1
+REBUILD_FRACTION = 0.05
+
+# cars that can wait to enter each lane; further arrivals are dropped and counted
+ENTRY_QUEUE_CAPACITY = 200
+
+# time allowed for a fresh interpreter to import the simulation core (seconds)
+IMPORT_TIME_BUDGET = 0.5
+
+# rows per on-disk chunk of a recorded trajectory, and chunks queued for writing before recording blocks
+RECORD_CHUNK_ROWS = 2**16
+RECORD_QUEUE_CHUNKS = 4
+
 PPM = 1.5
 
+# default physical timestep of one simulation tick (seconds)
+DT = 1/60
+# integration steps longer than this fraction of the shortest time headway are sub-stepped
+STABLE_STEP_FRACTION = 0.5
+# most integration steps a tick is split into, however short the headways
+MAX_SUBSTEPS = 64
+
 V_0_MU = 30
 T_MU = 2
+# shortest time headway a generated car can have (seconds)
+T_MIN = 0.5
 B_MU = 8
 A_MU = 4
 V_MU = 0.5
@@ -0,0 +1,410 @@
+"""
+Spatial domain decomposition of a road network across worker processes.
+
+The road/junction graph is split into regions of roughly equal lane length and
+each region is simulated by its own worker process. Every worker builds the full
+network geometry but only owns the cars on its own roads. Cars crossing a junction
+into a road owned by another region are handed over at the end of the tick and
+inserted by the owner before the next tick.
+
+A car only follows the car ahead of it in its own lane, never one across a
+junction, so the handover is all regions need from each other: the cars of a
+partitioned run move exactly as in a single simulation. check runs both on the
+same cars to confirm it.
+
+    python partition.py scen1 -p 4 -s 600 --seed 3
+    python partition.py scen4 -p 2 --check
+"""
+from sim import Simulation, load_scenario
+from car import Car, CarGenerator
+from ensemble import replicate_seed
+from parameters import DT, GEOMETRY_CACHE_DIR
+
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import sys
+import time
+from collections import deque
+
+
+def road_graph(sim):
+    """
+    Undirected adjacency between road indices, linked through junctions
+    """
+    road_index = {road: i for i, road in enumerate(sim.roads)}
+    adjacency = [set() for _ in sim.roads]
+
+    for junction in sim.junctions:
+        for out_lane, in_lanes in junction.lane_map.items():
+            a = road_index[out_lane.road]
+            for in_lane in in_lanes:
+                b = road_index[in_lane.road]
+                if a != b:
+                    adjacency[a].add(b)
+                    adjacency[b].add(a)
+
+    return adjacency
+
+
+def partition_roads(sim, n_regions):
+    """
+    Assign every road to one of n_regions regions.
+    Roads are visited breadth-first from the source roads and cut into contiguous
+    chunks of roughly equal total lane length, so regions stay connected and small
+    boundaries are favored.
+    Returns a list of region ids indexed by road.
+    """
+    adjacency = road_graph(sim)
+    weights = [sum(lane.length for lane in road.lanes) for road in sim.roads]
+    total = sum(weights)
+
+    road_index = {road: i for i, road in enumerate(sim.roads)}
+    starts = [road_index[road] for road in sim.road_ends] + list(range(len(sim.roads)))
+
+    order = []
+    seen = set()
+    for start in starts:
+        if start in seen:
+            continue
+        seen.add(start)
+        queue = deque([start])
+        while queue:
+            road = queue.popleft()
+            order.append(road)
+            for neighbor in sorted(adjacency[road]):
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    queue.append(neighbor)
+
+    regions = [0]*len(sim.roads)
+    cumulative = 0
+    for road in order:
+        # region of the midpoint of this road's weight
+        regions[road] = min(n_regions-1, int((cumulative + weights[road]/2) / total * n_regions)) if total else 0
+        cumulative += weights[road]
+
+    return regions
+
+
+class RegionSimulation(Simulation):
+    """
+    Simulation of the cars on the roads owned by one region
+    """
+    def __init__(self, scenario, regions, region, seed=None, vectorized=False, dt=DT, substeps=1,
+                 geometry_cache=GEOMETRY_CACHE_DIR):
+        super().__init__(scenario=scenario, vectorized=vectorized, seed=seed, dt=dt, substeps=substeps,
+                         geometry_cache=geometry_cache)
+        self.add_roads()
+
+        n_regions = max(regions) + 1
+        self.region = region
+        self.road_region = {road: regions[i] for i, road in enumerate(self.roads)}
+        self.lane_index = {lane: (i, j) for i, road in enumerate(self.roads) for j, lane in enumerate(road.lanes)}
+
+        # only spawn on owned sources; the per-source spawn rate is unchanged
+        self.road_ends = [road for road in self.road_ends if self.road_region[road] == region]
+
+        # unique car ids across regions
+        self.car_id = region
+        self.car_id_step = n_regions
+
+        # keep the network-wide rate of random lane changes
+        self.lane_change_interval *= n_regions
+
+        self.emigrating = []
+        self.emigrated_cars = 0
+        self.immigrated_cars = 0
+
+
+    def owns(self, lane):
+        return self.road_region[lane.road] == self.region
+
+
+    def end_of_lane(self, car):
+        super().end_of_lane(car)
+
+        if car.car_id not in self.dead_cars and not self.owns(car.lane):
+            # hand the car over at the end of the tick, once stepping is done
+            self.emigrating.append(car)
+
+
+    def update(self):
+        super().update()
+
+        emigrants = []
+        for car in self.emigrating:
+            if car.car_id not in self.cars:
+                continue
+            self.remove_car(car.car_id)
+            emigrants.append((self.lane_index[car.lane], car.get_state()))
+        self.emigrating = []
+        self.emigrated_cars += len(emigrants)
+
+        return emigrants
+
+
+    def immigrate(self, emigrants):
+        insert_cars(self, emigrants)
+        self.immigrated_cars += len(emigrants)
+
+
+def insert_cars(sim, cars):
+    """
+    Add cars given as ((road, lane), state) to a simulation, in order
+    """
+    for (road, lane), state in cars:
+        sim.insert_car(Car.from_state(state, sim.roads[road].lanes[lane]))
+
+
+def deliver(emigrants, regions, n_regions):
+    """
+    Sort cars handed over by any region into the inboxes of the regions owning their roads
+    """
+    inbox = [[] for _ in range(n_regions)]
+    for emigrant in emigrants:
+        (road, _), _ = emigrant
+        inbox[regions[road]].append(emigrant)
+    return inbox
+
+
+def region_worker(conn, scenario, regions, region, seed, vectorized, dt, substeps, geometry_cache):
+    sim = RegionSimulation(load_scenario(scenario), regions, region, seed=replicate_seed(seed, region),
+                           vectorized=vectorized, dt=dt, substeps=substeps, geometry_cache=geometry_cache)
+
+    busy = 0
+    while True:
+        message = conn.recv()
+        if message[0] == 'stop':
+            break
+
+        _, immigrants = message
+        start = time.perf_counter()
+        sim.immigrate(immigrants)
+        emigrants = sim.update()
+        busy += time.perf_counter() - start
+
+        conn.send(emigrants)
+
+    conn.send({
+        'region': region,
+        'roads': sum(1 for r in regions if r == region),
+        'cars_spawned': sim.spawned_cars,
+        'cars_exited': sim.exited_cars,
+        'cars_live': len(sim.cars),
+        'cars_emigrated': sim.emigrated_cars,
+        'cars_immigrated': sim.immigrated_cars,
+        'busy_seconds': busy,
+    })
+    conn.close()
+
+
+def run_partitioned(scenario, n_regions, ticks=None, seconds=None, seed=0, vectorized=False, dt=DT, substeps=1,
+                    geometry_cache=GEOMETRY_CACHE_DIR):
+    """
+    Run one simulation split across n_regions worker processes and return summary metrics
+    """
+    # the coordinator only needs the network topology to assign roads to regions; building
+    # it also fills the geometry cache, so the workers all read their roads from it
+    layout = Simulation(scenario=load_scenario(scenario), geometry_cache=geometry_cache)
+    layout.add_roads()
+    regions = partition_roads(layout, n_regions)
+    n_regions = max(regions) + 1
+
+    if ticks is None:
+        ticks = int(round((seconds or 0) / dt))
+
+    conns, workers = [], []
+    for region in range(n_regions):
+        parent, child = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=region_worker,
+                                         args=(child, scenario, regions, region, seed, vectorized, dt, substeps,
+                                               geometry_cache))
+        worker.start()
+        conns.append(parent)
+        workers.append(worker)
+
+    inbox = [[] for _ in range(n_regions)]
+    migrations = 0
+
+    start = time.perf_counter()
+    for _ in range(ticks):
+        for region, conn in enumerate(conns):
+            conn.send(('step', inbox[region]))
+
+        emigrants = [emigrant for conn in conns for emigrant in conn.recv()]
+        inbox = deliver(emigrants, regions, n_regions)
+        migrations += len(emigrants)
+    wall = time.perf_counter() - start
+
+    region_stats = []
+    for conn, worker in zip(conns, workers):
+        conn.send(('stop',))
+        region_stats.append(conn.recv())
+        worker.join()
+
+    return {
+        'scenario': scenario,
+        'seed': seed,
+        'regions': n_regions,
+        'dt': dt,
+        'ticks': ticks,
+        'sim_seconds': ticks * dt,
+        'wall_seconds': wall,
+        'ticks_per_second': ticks / wall if wall else None,
+        'migrations': migrations,
+        'cars_spawned': sum(stats['cars_spawned'] for stats in region_stats),
+        'cars_exited': sum(stats['cars_exited'] for stats in region_stats),
+        # cars handed over on the last tick are still in flight
+        'cars_live': sum(stats['cars_live'] for stats in region_stats) + sum(len(cars) for cars in inbox),
+        'region_stats': region_stats,
+    }
+
+
+def check_cars(sim, seed=0, spacing=60):
+    """
+    Cars spaced along every lane of the source roads as ((road, lane), state), each
+    lane listed front to back so leaders come first as they would cross a junction
+    """
+    rng = random.Random(seed)
+    cars = []
+    car_id = 0
+    for i, road in enumerate(sim.roads):
+        if road not in sim.road_ends:
+            continue
+        for j, lane in enumerate(road.lanes):
+            x = lane.length - spacing/2
+            while x > 0:
+                car = Car(CarGenerator.generate_car(rng=rng), car_id, lane)
+                lane.remove_car(car)
+                state = car.get_state()
+                state['x'] = x
+                cars.append(((i, j), state))
+                car_id += 1
+                x -= spacing
+    return cars
+
+
+def car_states(sims):
+    """
+    (road, lane, x, v) of every car of the simulations by car id
+    """
+    states = {}
+    for sim in sims:
+        # each simulation has its own copy of the network, so lanes are compared by index
+        lanes = {lane: (i, j) for i, road in enumerate(sim.roads) for j, lane in enumerate(road.lanes)}
+        for car in sim.cars.values():
+            states[car.car_id] = (*lanes[car.lane], float(car.x), float(car.v))
+    return states
+
+
+def check(scenario, n_regions, ticks=None, seconds=None, seed=0, vectorized=False, dt=DT, tolerance=1e-6):
+    """
+    Run the same cars through a single simulation and through its regions, handing
+    cars over between regions as run_partitioned does, and compare every car after
+    every tick. Spawning and random lane changes are turned off so nothing but the
+    cars placed at the start moves, and the regions are stepped in this process.
+    Since lane_change_interval is infinite here, the scaling of the lane change
+    interval by the number of regions in RegionSimulation is not checked.
+    migrations is reported but not required: a network without junctions between
+    regions is partitioned correctly too, it just never hands a car over.
+    """
+    reference = Simulation(scenario=load_scenario(scenario), seed=seed, vectorized=vectorized, dt=dt)
+    reference.add_roads()
+    regions = partition_roads(reference, n_regions)
+    n_regions = max(regions) + 1
+    parts = [RegionSimulation(load_scenario(scenario), regions, region, seed=seed, vectorized=vectorized, dt=dt)
+             for region in range(n_regions)]
+
+    cars = check_cars(reference, seed)
+    insert_cars(reference, cars)
+    for region, inbox in enumerate(deliver(cars, regions, n_regions)):
+        insert_cars(parts[region], inbox)
+    for sim in [reference] + parts:
+        sim.road_ends = []
+        sim.lane_change_interval = math.inf
+
+    if ticks is None:
+        ticks = int(round((seconds or 0) / dt))
+
+    migrations = 0
+    max_x_error = max_v_error = 0
+    mismatch = None
+    for tick in range(1, ticks+1):
+        reference.update()
+        emigrants = [emigrant for part in parts for emigrant in part.update()]
+        for part, inbox in zip(parts, deliver(emigrants, regions, n_regions)):
+            part.immigrate(inbox)
+        migrations += len(emigrants)
+
+        expected, actual = car_states([reference]), car_states(parts)
+        if expected.keys() != actual.keys():
+            mismatch = f'tick {tick}: cars {sorted(expected.keys() ^ actual.keys())} are only in one run'
+            break
+        for car_id, (road, lane, x, v) in expected.items():
+            other_road, other_lane, other_x, other_v = actual[car_id]
+            if (road, lane) != (other_road, other_lane):
+                mismatch = f'tick {tick}: car {car_id} is on lane {road}.{lane}, not {other_road}.{other_lane}'
+                break
+            max_x_error = max(max_x_error, abs(x - other_x))
+            max_v_error = max(max_v_error, abs(v - other_v))
+        if mismatch:
+            break
+
+    return {
+        'scenario': scenario,
+        'regions': n_regions,
+        'vectorized': vectorized,
+        'ticks': ticks,
+        'cars': len(cars),
+        'cars_exited': reference.exited_cars,
+        'migrations': migrations,
+        'max_position_error': max_x_error,
+        'max_speed_error': max_v_error,
+        'mismatch': mismatch,
+        'ok': mismatch is None and max(max_x_error, max_v_error) <= tolerance,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run one simulation split into regions across worker processes.')
+    parser.add_argument('scenario', nargs='?', default='scen4', help='scenario module in scenarios/')
+    parser.add_argument('-p', '--regions', type=int, default=2, help='number of regions/worker processes')
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument('-n', '--ticks', type=int, help='number of ticks to simulate')
+    length.add_argument('-s', '--seconds', type=float, help='simulated seconds to run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--vectorized', action='store_true', help='step cars with the vectorized engine')
+    parser.add_argument('--dt', type=float, default=DT, help='simulated seconds per tick')
+    parser.add_argument('--substeps', type=int, default=1, help='integration steps per tick')
+    parser.add_argument('--geometry-cache', default=GEOMETRY_CACHE_DIR, metavar='DIR',
+                        help='read and save road geometry in this cache directory, shared by the workers')
+    parser.add_argument('-o', '--out', help='write the metrics to this JSON file')
+    parser.add_argument('--check', action='store_true',
+                        help='check that the cars of a partitioned run move exactly as in a single simulation')
+    args = parser.parse_args()
+
+    # one simulated minute by default
+    seconds = args.seconds if args.ticks is not None or args.seconds is not None else 60
+
+    if args.check:
+        result = check(args.scenario, args.regions, ticks=args.ticks, seconds=seconds, seed=args.seed,
+                       vectorized=args.vectorized, dt=args.dt)
+        print(json.dumps(result, indent=2))
+        sys.exit(0 if result['ok'] else 1)
+
+    metrics = run_partitioned(args.scenario, args.regions, ticks=args.ticks, seconds=seconds,
+                              seed=args.seed, vectorized=args.vectorized, dt=args.dt, substeps=args.substeps,
+                              geometry_cache=args.geometry_cache)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(metrics, f, indent=2)
+    else:
+        print(json.dumps(metrics, indent=2))
+
+
+if __name__ == '__main__':
+    main()
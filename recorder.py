@@ -0,0 +1,371 @@
+"""
+Streaming trajectory recorder.
+
+Per-tick car state is appended to in-memory column buffers of RECORD_CHUNK_ROWS
+rows. Full buffers are handed to a writer thread which saves every column of the
+chunk as its own .npy file, so a run of any length records in constant memory
+and readers can memory-map single columns of single chunks:
+
+    run/
+        manifest.json
+        chunk_000000/tick.npy, time.npy, car_id.npy, road.npy, lane.npy, ...
+        chunk_000001/...
+
+Rows are written in tick order and a tick is never split across chunks. Every
+recorded tick holds all cars on the road, so each one is a keyframe: the manifest
+lists the tick range of every chunk and each chunk has an index.npy of
+(tick, first row) pairs, which lets readers seek to any tick with two binary
+searches. World positions are looked up from the
+lane arc-length tables by the writer thread, not while stepping.
+"""
+from parameters import RECORD_CHUNK_ROWS, RECORD_QUEUE_CHUNKS, DT
+
+import numpy as np
+
+import json
+import os
+import queue
+import threading
+
+
+# recorded columns and their types; positions and car lengths are in pixels and speeds in pixels/second
+RECORD_FIELDS = (
+    ('tick', np.int64),
+    ('time', np.float64),
+    ('car_id', np.int64),
+    ('road', np.int32),
+    ('lane', np.int32),
+    ('x', np.float32),
+    ('v', np.float32),
+    ('acc', np.float32),
+    ('l', np.float32),
+    ('px', np.float32),
+    ('py', np.float32),
+)
+
+MANIFEST = 'manifest.json'
+
+
+def chunk_name(i):
+    return f'chunk_{i:06d}'
+
+
+def road_definitions(roads):
+    """
+    Road definitions in the dict form of scenario files, enough to rebuild the
+    geometry of a recorded network
+    """
+    return [{'endpoints': np.asarray(road.path).tolist(), 'n_lanes': road.n_lanes,
+             'one_way': road.one_way, 'is_source': False} for road in roads]
+
+
+class TrajectoryRecorder:
+    """
+    Records the cars of a simulation every `every` ticks to the directory at path.
+    Attach it with sim.recorder = recorder, or call record(sim) after each update.
+    """
+    def __init__(self, path, sim=None, every=1, chunk_rows=RECORD_CHUNK_ROWS):
+        self.path = path
+        self.every = every
+        self.chunk_rows = chunk_rows
+        os.makedirs(path, exist_ok=True)
+
+        self.chunks = []
+        self.rows = 0
+        self.buffers = self.new_buffers()
+        # (tick, first row) of every tick in the current chunk
+        self.keyframes = []
+        self.first_tick = None
+        self.last_tick = None
+
+        # numbering of every lane, refreshed when roads are added
+        self.lanes = []
+        self.lane_index = {}
+        self.lane_roads = self.lane_numbers = np.empty(0, dtype=np.int32)
+        self.n_roads = 0
+        self.roads = []
+        # lane number of every lane id of the engine, extended as the engine meets new lanes
+        self.engine_lanes = np.empty(0, dtype=np.int32)
+
+        self.metadata = {}
+        if sim is not None:
+            self.metadata = {
+                'scenario': getattr(sim.scenario, '__name__', None) or getattr(sim.scenario, 'name', None),
+                'dt': sim.dt,
+            }
+
+        self.closed = False
+        self.error = None
+        self.queue = queue.Queue(maxsize=RECORD_QUEUE_CHUNKS)
+        self.writer = threading.Thread(target=self.write_chunks, daemon=True)
+        self.writer.start()
+
+
+    def new_buffers(self, rows=None):
+        return {name: np.empty(rows or self.chunk_rows, dtype=dtype) for name, dtype in RECORD_FIELDS}
+
+
+    def index_lanes(self, sim):
+        """
+        Number every lane of the network; rows store this number until the chunk
+        is written, when it is expanded to (road, lane) indices and world positions
+        """
+        if len(sim.roads) != self.n_roads:
+            self.lanes = [lane for road in sim.roads for lane in road.lanes]
+            self.lane_index = {lane: i for i, lane in enumerate(self.lanes)}
+            self.lane_roads = np.array([i for i, road in enumerate(sim.roads) for _ in road.lanes], dtype=np.int32)
+            self.lane_numbers = np.array([j for road in sim.roads for j in range(len(road.lanes))], dtype=np.int32)
+            self.n_roads = len(sim.roads)
+            self.roads = road_definitions(sim.roads)
+            self.engine_lanes = np.empty(0, dtype=np.int32)
+
+
+    def engine_lane_numbers(self, engine):
+        """
+        Lane numbers indexed by the lane ids of the engine, only looking up lanes
+        the engine has added since the last call
+        """
+        known = len(self.engine_lanes)
+        if len(engine.lanes) > known:
+            new = np.array([self.lane_index.get(lane, -1) for lane in engine.lanes[known:]], dtype=np.int32)
+            self.engine_lanes = np.concatenate((self.engine_lanes, new))
+        return self.engine_lanes
+
+
+    def record(self, sim):
+        """
+        Append the state of every car if this tick is due
+        """
+        if sim.tick % self.every:
+            return
+        if self.error:
+            raise self.error
+
+        self.index_lanes(sim)
+        if self.first_tick is None:
+            self.first_tick = sim.tick
+        self.last_tick = sim.tick
+
+        engine = sim.engine
+        n = engine.n_cars if engine else len(sim.cars)
+
+        # ticks never straddle chunks, so a tick can be read from a single chunk
+        if self.rows + n > len(self.buffers['tick']):
+            self.flush()
+            if n > self.chunk_rows:
+                self.buffers = self.new_buffers(n)
+
+        self.keyframes.append((sim.tick, self.rows))
+        rows = slice(self.rows, self.rows + n)
+        buffers = self.buffers
+        buffers['tick'][rows] = sim.tick
+        buffers['time'][rows] = sim.time
+
+        if engine:
+            idx = np.flatnonzero(engine.alive)
+            lane_ids = self.engine_lane_numbers(engine)
+            buffers['car_id'][rows] = engine.car_id[idx]
+            buffers['lane'][rows] = lane_ids[engine.lane[idx]]
+            buffers['x'][rows] = engine.x[idx]
+            buffers['v'][rows] = engine.v[idx]
+            buffers['acc'][rows] = engine.acc[idx]
+            buffers['l'][rows] = engine.l[idx]
+        else:
+            cars = sim.cars.values()
+            lane_index = self.lane_index
+            buffers['car_id'][rows] = [car.car_id for car in cars]
+            buffers['lane'][rows] = [lane_index.get(car.lane, -1) for car in cars]
+            buffers['x'][rows] = [car.x for car in cars]
+            buffers['v'][rows] = [car.v for car in cars]
+            buffers['acc'][rows] = [car.acc for car in cars]
+            buffers['l'][rows] = [car.l for car in cars]
+
+        self.rows += n
+        if self.rows >= self.chunk_rows or len(self.keyframes) >= self.chunk_rows:
+            self.flush()
+
+
+    def flush(self):
+        """
+        Hand the buffered rows to the writer thread. Raises the error that stopped
+        the writer, if any.
+        """
+        if self.error:
+            raise self.error
+        if not self.keyframes:
+            return
+
+        buffers = {name: buffer[:self.rows] for name, buffer in self.buffers.items()}
+        keyframes = np.array(self.keyframes, dtype=np.int64)
+        chunk = {'name': chunk_name(len(self.chunks)), 'rows': self.rows,
+                 'first_tick': int(keyframes[0, 0]), 'last_tick': int(keyframes[-1, 0])}
+        self.chunks.append(chunk)
+        self.queue.put((chunk, buffers, keyframes, self.lanes, self.lane_roads, self.lane_numbers))
+
+        self.buffers = self.new_buffers()
+        self.keyframes = []
+        self.rows = 0
+
+
+    @staticmethod
+    def expand_lanes(buffers, lanes, lane_roads, lane_numbers):
+        """
+        Fill in the road and lane indices and world positions of a chunk, looking up
+        the positions of all rows on the same lane at once
+        """
+        lane_ids = buffers['lane'].copy()
+        known = lane_ids >= 0
+        buffers['road'][:] = -1
+        buffers['road'][known] = lane_roads[lane_ids[known]]
+        buffers['lane'][known] = lane_numbers[lane_ids[known]]
+
+        order = np.argsort(lane_ids, kind='stable')
+        sorted_ids = lane_ids[order]
+        starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        ends = np.r_[starts[1:], len(order)]
+
+        buffers['px'][:] = np.nan
+        buffers['py'][:] = np.nan
+        for start, end in zip(starts, ends):
+            if sorted_ids[start] < 0:
+                continue
+            rows = order[start:end]
+            pos = lanes[sorted_ids[start]].get_positions(buffers['x'][rows])[0]
+            buffers['px'][rows] = pos[:, 0]
+            buffers['py'][rows] = pos[:, 1]
+
+
+    def write_chunks(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error:
+                # keep draining the queue after a failure so flush and close never block on it
+                continue
+
+            chunk, buffers, keyframes, lanes, lane_roads, lane_numbers = item
+            try:
+                self.expand_lanes(buffers, lanes, lane_roads, lane_numbers)
+                directory = os.path.join(self.path, chunk['name'])
+                os.makedirs(directory, exist_ok=True)
+                np.save(os.path.join(directory, 'index.npy'), keyframes)
+                for name, buffer in buffers.items():
+                    np.save(os.path.join(directory, f'{name}.npy'), buffer)
+            except Exception as e:
+                self.error = e
+
+
+    def write_manifest(self):
+        manifest = {
+            'fields': [(name, np.dtype(dtype).str) for name, dtype in RECORD_FIELDS],
+            'every': self.every,
+            'chunk_rows': self.chunk_rows,
+            'first_tick': self.first_tick,
+            'last_tick': self.last_tick,
+            'chunks': self.chunks,
+            'roads': self.roads,
+            **self.metadata,
+        }
+        with open(os.path.join(self.path, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+    def close(self):
+        """
+        Write out the remaining rows and the manifest, waiting for the writer to finish
+        """
+        if self.closed:
+            return
+
+        try:
+            self.flush()
+        finally:
+            self.queue.put(None)
+            self.writer.join()
+            self.closed = True
+
+        self.write_manifest()
+
+        if self.error:
+            raise self.error
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TrajectoryReader:
+    """
+    Read access to a recorded trajectory. Columns are memory-mapped, so only the
+    chunks that are touched are read from disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+
+        self.fields = [name for name, _ in self.manifest['fields']]
+        self.chunks = self.manifest['chunks']
+        self.every = self.manifest['every']
+        self.dt = self.manifest.get('dt') or DT
+        self.first_tick = self.manifest['first_tick']
+        self.last_tick = self.manifest['last_tick']
+
+        self.chunk_starts = np.array([chunk['first_tick'] for chunk in self.chunks], dtype=np.int64)
+        # columns and keyframe index of the last chunk seeked into
+        self.cached = None
+
+
+    def __len__(self):
+        return sum(chunk['rows'] for chunk in self.chunks)
+
+
+    def chunk(self, i, fields=None):
+        """
+        Memory-mapped columns of chunk i
+        """
+        directory = os.path.join(self.path, self.chunks[i]['name'])
+        return {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+                for name in (fields or self.fields)}
+
+
+    def keyframes(self, i):
+        """
+        (tick, first row) of every tick recorded in chunk i
+        """
+        return np.load(os.path.join(self.path, self.chunks[i]['name'], 'index.npy'))
+
+
+    def frame(self, tick):
+        """
+        Columns of every car at the last recorded tick at or before tick, or at the
+        first recorded tick if there is none. Returns (recorded tick, columns).
+        """
+        i = max(0, np.searchsorted(self.chunk_starts, tick, side='right') - 1)
+        if self.cached is None or self.cached[0] != i:
+            self.cached = i, self.chunk(i), self.keyframes(i)
+        _, columns, keyframes = self.cached
+
+        j = max(0, np.searchsorted(keyframes[:, 0], tick, side='right') - 1)
+        start = keyframes[j, 1]
+        end = keyframes[j+1, 1] if j+1 < len(keyframes) else self.chunks[i]['rows']
+
+        return int(keyframes[j, 0]), {name: column[start:end] for name, column in columns.items()}
+
+
+    def iter_chunks(self, fields=None):
+        for i in range(len(self.chunks)):
+            yield self.chunk(i, fields)
+
+
+    def column(self, name):
+        """
+        A whole column loaded into memory
+        """
+        return np.concatenate([chunk[name] for chunk in self.iter_chunks((name,))]) if self.chunks \
+            else np.empty(0, dtype=dict(self.manifest['fields'])[name])
@@ -1,17 +1,45 @@
 from math_functions import *
-from bezier import Bezier, LinearBezier
+from bezier import Bezier, LinearBezier, interpolate_curves, tangent_curves, arclength_curves
 from parameters import *
 
+from bisect import bisect_left, bisect_right
+from operator import attrgetter
+
+car_position = attrgetter('x')
+
+def compute_control_points(paths):
+    """
+    Compute the control points of the cubic Bezier segments joining the points of a
+    path of shape (n, 2), or of several paths stacked as (k, n, 2).
+    Returns an array of shape (..., n-1, 4, 2)
+    """
+    paths = np.asarray(paths, dtype=float)
+    P0, P3 = paths[..., :-1, :], paths[..., 1:, :]
+
+    if paths.shape[-2] < 3:
+        # cannot do b-spline interp - the segment is a straight line
+        P1, P2 = trisect_line_segment(P0, P3)
+    else:
+        b_splines = cubic_spline_interpolation(paths)
+        P1, P2 = trisect_line_segment(b_splines[..., :-1, :], b_splines[..., 1:, :])
+
+    return np.stack((P0, P1, P2, P3), axis=-2)
+
+
 class Lane:
-    def __init__(self, path, road, beziers, is_key=False, left_lane=None, right_lane=None, lane_width=LANE_WIDTH):
+    def __init__(self, path, road, control_points, length=None, is_key=False, left_lane=None, right_lane=None, lane_width=LANE_WIDTH):
         self.path = path
         self.road = road
-        self.beziers = beziers
+        self.control_points = control_points
         self.is_key = is_key
 
-        self.length = sum([bezier.arclength() for bezier in self.beziers])
+        if length is None:
+            length = arclength_curves(control_points).sum()
+        self.length = float(length)
         self.endpoints = path[0], path[-1]
-        self.bezier_paths = [bezier.LUT() for bezier in beziers]
+
+        # Bezier objects, built on first use
+        self._beziers = None
         
         self.left_lane = left_lane
         self.right_lane = right_lane
@@ -20,80 +48,268 @@ class Lane:
         self.next_junction = None
         self.prev_junctions = []
 
-        self.last_car = None
+        # cars ordered by position from the rearmost to the frontmost
+        self.car_order = []
+
+        # arc-length lookup table, built on first use
+        self.arc_table = None
+
+
+    @property
+    def beziers(self):
+        if self._beziers is None:
+            if len(self.path) < 3:
+                self._beziers = [LinearBezier(P0, P3) for P0, _, _, P3 in self.control_points]
+            else:
+                self._beziers = [Bezier(*P) for P in self.control_points]
+        return self._beziers
+
+
+    @property
+    def bezier_paths(self):
+        # look-up tables are built on first use and cached in bezier.LUT_CACHE
+        return [bezier.LUT() for bezier in self.beziers]
+
+
+    @property
+    def last_car(self):
+        return self.car_order[0] if self.car_order else None
+
+
+    def index_of(self, car):
+        """
+        Locate a car in the position index, resolving ties in position by identity.
+        If a car has passed another since the lane was last put in order, the order
+        is repaired first.
+        """
+        i = self.find(car)
+        if i is None:
+            self.sort_cars()
+            i = self.find(car)
+        if i is None:
+            raise ValueError(f'car {car} is not on this lane')
+        return i
+
+
+    def find(self, car):
+        i = bisect_left(self.car_order, car.x, key=car_position)
+        for j in range(i, len(self.car_order)):
+            if self.car_order[j] is car:
+                return j
+            if self.car_order[j].x > car.x:
+                break
+        return None
+
+
+    def sort_cars(self):
+        """
+        Put the cars back in position order after one passed another (e.g. in a
+        collision) and link every car to its new neighbors. Cars at the same
+        position keep their order.
+        """
+        order = self.car_order
+        order.sort(key=car_position)
+        for i, car in enumerate(order):
+            car.trail_car = order[i-1] if i > 0 else None
+            car.lead_car = order[i+1] if i+1 < len(order) else None
+
+
+    def insert_car(self, car):
+        """
+        Insert a car into the lane at its current position and link it to its neighbors.
+        A car entering at the same position as another car is placed behind it.
+        """
+        i = bisect_left(self.car_order, car.x, key=car_position)
+        self.car_order.insert(i, car)
+        self.cars[car.car_id] = car
+
+        car.trail_car = self.car_order[i-1] if i > 0 else None
+        car.lead_car = self.car_order[i+1] if i+1 < len(self.car_order) else None
+        if car.trail_car:
+            car.trail_car.lead_car = car
+        if car.lead_car:
+            car.lead_car.trail_car = car
+
+
+    def remove_car(self, car):
+        """
+        Remove a car from the lane and link its neighbors to each other.
+        """
+        del self.car_order[self.index_of(car)]
+        del self.cars[car.car_id]
+
+        if car.trail_car:
+            car.trail_car.lead_car = car.lead_car
+        if car.lead_car:
+            car.lead_car.trail_car = car.trail_car
+        car.lead_car = None
+        car.trail_car = None
+
+
+    def build_arc_table(self, samples=ARC_TABLE_SAMPLES):
+        """
+        Sample every Bezier segment of the lane and resample the points and unit
+        tangents at evenly-spaced arc-lengths along the whole lane.
+        """
+        control_points = self.control_points
+        ts = np.linspace(0, 1, samples)
+
+        # evaluate every segment at once and offset the partial arc-lengths of each
+        # segment by the length of the segments before it
+        points = interpolate_curves(control_points, ts)
+        tangents = tangent_curves(control_points, ts)
+        seg_s = arclength_curves(control_points, ts)
+        seg_s[1:] += np.cumsum(seg_s[:-1, -1])[:, None]
+
+        # drop the first sample of every segment after the first since it is the
+        # end point of the previous segment
+        keep = np.ones(seg_s.shape, dtype=bool)
+        keep[1:, 0] = False
+        points, tangents, s = points[keep], tangents[keep], seg_s[keep]
+
+        n = len(points)
+        s_even = np.linspace(0, s[-1], n)
+        points = np.column_stack([np.interp(s_even, s, points[:, k]) for k in range(2)])
+        tangents = np.column_stack([np.interp(s_even, s, tangents[:, k]) for k in range(2)])
+        tangents /= np.hypot(*tangents.T)[:, None]
+
+        step = s_even[1] if n > 1 and s[-1] > 0 else 1
+        self.arc_table = (step, points, tangents)
+
+        return self.arc_table
+
+
+    def get_positions(self, xs):
+        """
+        Return the world positions and unit headings for an array of distances
+        along the lane, interpolated from the arc-length table.
+        """
+        step, points, tangents = self.arc_table or self.build_arc_table()
+
+        d = np.clip(np.asarray(xs, dtype=float)/step, 0, len(points)-1)
+        i = np.minimum(d.astype(int), len(points)-2)
+        w = (d - i)[..., None]
+
+        pos = points[i] + w*(points[i+1] - points[i])
+        heading = tangents[i] + w*(tangents[i+1] - tangents[i])
+        heading /= np.hypot(heading[..., 0], heading[..., 1])[..., None]
+
+        return pos, heading
+
+
+    def get_position(self, x):
+        return self.get_positions(x)[0]
+
+
+    def get_heading(self, x):
+        return tuple(self.get_positions(x)[1].tolist())
+
+
+    def get_neighbors(self, x):
+        """
+        Return the (lead, trail) cars directly ahead of and behind position x.
+        Either may be None.
+        """
+        i = bisect_right(self.car_order, x, key=car_position)
+        lead = self.car_order[i] if i < len(self.car_order) else None
+        trail = self.car_order[i-1] if i > 0 else None
+        return lead, trail
+
+
+def road_geometry(key_paths, n_lanes, one_way=False):
+    """
+    Compute the lanes of k roads with the same number of points and lanes at once,
+    from their key paths of shape (k, n, 2).
+    Returns the key lane control points and lengths and the paths, control points
+    and lengths of every lane, each with a leading axis over the roads.
+    """
+    key_paths = np.asarray(key_paths, dtype=float)
+    key_control_points = compute_control_points(key_paths)
+    key_lengths = arclength_curves(key_control_points).sum(axis=-1)
+
+    # every lane is offset from the key lane along its normals in a single pass
+    key_tans = np.concatenate((tangent_curves(key_control_points, 0),
+                               tangent_curves(key_control_points[:, -1:], 1)), axis=-2)
+    key_orthonorms = np.stack((-key_tans[..., 1], key_tans[..., 0]), axis=-1)
+    key_orthonorms /= np.hypot(key_orthonorms[..., 0], key_orthonorms[..., 1])[..., None]
+
+    trans_d = LANE_WIDTH*np.arange(1, n_lanes+1)[:, None, None] * key_orthonorms[:, None]
+
+    # forward lanes, then backward lanes which run in the opposite direction
+    paths = [key_paths[:, None] + trans_d]
+    if not one_way:
+        paths.append((key_paths[:, None] - trans_d)[..., ::-1, :])
+    paths = np.concatenate(paths, axis=1)
+
+    # solve the splines and arc-lengths of every lane together
+    control_points = compute_control_points(paths)
+    lengths = arclength_curves(control_points).sum(axis=-1)
+
+    return key_control_points, key_lengths, paths, control_points, lengths
+
+
+def build_roads(paths, n_lanes, one_way):
+    """
+    Build many roads, computing the geometry of all roads with the same number of
+    points and lanes together. Returns the roads in the order given.
+    """
+    groups = {}
+    for i, path in enumerate(paths):
+        groups.setdefault((len(path), n_lanes[i], one_way[i]), []).append(i)
+
+    roads = [None]*len(paths)
+    for (_, lanes, one_way_group), group in groups.items():
+        key_paths = np.array([paths[i] for i in group], dtype=float)
+        geometry = road_geometry(key_paths, lanes, one_way_group)
+        for j, i in enumerate(group):
+            roads[i] = Road(key_paths[j], n_lanes=lanes, one_way=one_way_group,
+                            geometry=[array[j] for array in geometry])
+
+    return roads
 
 
 class Road:
-    def __init__(self, path, n_lanes=3):
+    def __init__(self, path, n_lanes=3, one_way=False, geometry=None):
         # simulation variables
         self.path = path
-        self.beziers = self.compute_beziers(path)
             
         self.endpoints = path[0], path[-1]
         self.n_lanes = n_lanes
+        self.one_way = one_way
 
         # math initialization
         self.unit_vec = get_unit_vec(self.endpoints)
         self.orthonormal = get_orthonormal_vector(vec=self.unit_vec)
 
         # linkage to other classes
-        self.key_lane = Lane(path=self.path, road=self, beziers=self.beziers, is_key=True)
-        self.forward_lanes = [None]
-        self.backward_lanes = [None]
-
-        # compute the new lane data
-        key_points = path
-        key_tans = [bezier.tangent(0) for bezier in self.beziers]
-        key_tans.append(self.beziers[-1].tangent(1))
-        key_orthonorms = [get_orthonormal_vector(vec=key_tan) for key_tan in key_tans]
-
-        # forward lanes
-        for i in range(1, n_lanes+1):
-            trans_d = [[k*i*LANE_WIDTH for k in key_orthonorm] for key_orthonorm in key_orthonorms]
-            trans_path = [[kx+kdx, ky+kdy] for (kx, ky), (kdx, kdy) in zip(key_points, trans_d)]
-            
-            self.build_lane(trans_path, self.forward_lanes, i)
-        
-        # backward lanes
-        for i in range(1, n_lanes+1):
-            trans_d = [[k*i*LANE_WIDTH for k in key_orthonorm] for key_orthonorm in key_orthonorms]
-            trans_path = [[kx-kdx, ky-kdy] for (kx, ky), (kdx, kdy) in zip(key_points, trans_d)][::-1]
-            
-            self.build_lane(trans_path, self.backward_lanes, i)
-        
-        self.forward_lanes.pop(0)
-        self.backward_lanes.pop(0)
+        key_points = np.asarray(path, dtype=float)
+        if geometry is None:
+            geometry = [array[0] for array in road_geometry(key_points[None], n_lanes, one_way)]
+        key_control_points, key_length, paths, control_points, lengths = geometry
+
+        self.key_lane = Lane(path=key_points, road=self, control_points=key_control_points,
+                             length=key_length, is_key=True)
+
+        lanes = [Lane(path=p, road=self, control_points=cp, length=length)
+                 for p, cp, length in zip(paths, control_points, lengths.tolist())]
+
+        self.forward_lanes = self.link_lanes(lanes[:n_lanes])
+        self.backward_lanes = self.link_lanes(lanes[n_lanes:])
         
         self.lanes = self.backward_lanes + self.forward_lanes
 
     
-    def build_lane(self, path, lanes, lane_idx):
-        beziers = self.compute_beziers(path)
-
-        # recompute b_spline
-        lane = Lane(path=translate_coordinates(path, self.orthonormal, scale=lane_idx*LANE_WIDTH),
-                    road=self,
-                    beziers=beziers,
-                    left_lane=lanes[-1])
-        
-        if lanes[-1]:
-            lanes[-1].right_lane = lane
-        lanes.append(lane)
+    def link_lanes(self, lanes):
+        """
+        Link lanes of one direction, ordered from the key lane outwards, to their neighbors
+        """
+        for left, right in zip(lanes[:-1], lanes[1:]):
+            left.right_lane = right
+            right.left_lane = left
 
         return lanes
 
 
-    def compute_beziers(self, path):
-        if len(path) < 3:
-            # cannot do b-spline interp - construct beziers directly
-            beziers = [LinearBezier(*(np.array(pt) for pt in path))]
-        else:
-            b_splines = cubic_spline_interpolation(path)
-            beziers = []
-            for P2, Q2, P1, Q1 in zip(b_splines[:-1], b_splines[1:], path[:-1], path[1:]):
-                P2, Q2 = trisect_line_segment(P2, Q2)
-                P1, Q1 = np.array(P1), np.array(Q1)
-                bezier = Bezier(P1, P2, Q2, Q1)
-                beziers.append(bezier)
-        
-        return beziers
\ No newline at end of file
+    @property
+    def beziers(self):
+        return self.key_lane.beziers
@@ -0,0 +1,44 @@
+"""
+This scenario is a generated grid of one-way streets running east and south.
+At every intersection lane 0 continues straight, lane 1 turns into lane 1 of
+the crossing street and lane 2 leaves the network, so every street is a
+routing destination and no lane is fed by more than one junction lane.
+"""
+
+SIZE = 13
+SPACING = 200
+GAP = 15
+
+roads = []
+east = {}
+south = {}
+
+for i in range(SIZE):
+    for j in range(SIZE):
+        x, y = 100 + j * SPACING, 100 + i * SPACING
+        if j < SIZE - 1:
+            east[i, j] = len(roads)
+            roads.append({
+                'endpoints': ((x + GAP, y), (x + SPACING - GAP, y)),
+                'n_lanes': 3,
+                'one_way': True,
+                'is_source': j == 0
+            })
+        if i < SIZE - 1:
+            south[i, j] = len(roads)
+            roads.append({
+                'endpoints': ((x, y + GAP), (x, y + SPACING - GAP)),
+                'n_lanes': 3,
+                'one_way': True,
+                'is_source': i == 0
+            })
+
+road_map = []
+for streets, crossing, step in ((east, south, (0, 1)), (south, east, (1, 0))):
+    for (i, j), road in streets.items():
+        # the intersection the street ends at
+        end = (i + step[0], j + step[1])
+        if end in streets:
+            road_map.append(f'{road}.0-{streets[end]}.0')
+        if end in crossing:
+            road_map.append(f'{road}.1-{crossing[end]}.1')
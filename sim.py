@@ -1,112 +1,243 @@
-import dearpygui.dearpygui as dpg
-
 from car import Car, CarGenerator
 from road import Road
 from junction import Junction
+from engine import VectorEngine
+from lane_graph import LaneGraph, congestion_costs
+from network import Network
+from geometry_cache import GeometryCache
 from parameters import *
 
+import importlib
 import logging
+import math
 import random
+from collections import deque
+
+
+def load_scenario(name):
+    """
+    Import a scenario module from the scenarios package by name, e.g. 'scen4',
+    or load a .json or compiled .npz network file
+    """
+    if name.endswith(('.json', '.npz')):
+        return Network.load(name)
+    return importlib.import_module(f'scenarios.{name}')
+
 
 class Simulation:
-    def __init__(self, scenario=None, sim_len=50):
+    def __init__(self, scenario=None, sim_len=50, vectorized=False, seed=None, dt=DT, substeps=1, routing=False,
+                 reroute_interval=None, geometry_cache=GEOMETRY_CACHE_DIR):
         self.cars = {}
         self.roads = []
         self.road_ends = []
         self.junctions = []
+        # incremented whenever roads or junctions change, so views can cache the network
+        self.network_version = 0
         self.dead_cars = []
-        self.fps = 60
         self.ppm = 1
-        self.ticks_since_car = 0
-        self.ticks_since_lane_change = 0
+
+        # simulated seconds per tick, integrated in at least substeps steps
+        self.dt = dt
+        self.substeps = substeps
+        self.warned_substeps = False
+        # smallest time headway T of the cars, which sets the number of substeps. T is
+        # fixed per car, so this is kept up to date as cars come and go and only
+        # scanned for again once the car that had it leaves
+        self.min_headway = math.inf
+        self.min_headway_stale = False
+
+        # seconds between spawns on each source road and between random lane changes
+        # (150 and 400 frames at 60 fps)
+        self.spawn_interval = 150*DT
+        self.lane_change_interval = 400*DT
+        self.time_since_car = 0
+        self.time_since_lane_change = 0
+
+        self.sim_len = sim_len
+        self.tick = 0
+        self.time = 0
+        self.spawned_cars = 0
+        self.exited_cars = 0
+        # routed cars that left the network on their destination road
+        self.arrived_cars = 0
+
+        # cars waiting for room to enter each lane as (arrival time, car args), the
+        # cars turned away because a queue was full and the total time waited
+        self.entry_queues = {}
+        self.dropped_cars = 0
+        self.entry_delay = 0
+        # optional demand.Demand generating arrivals, in place of the fixed spawn interval
+        self.demand = None
 
         # autoincrement ids for retreival
         self.car_id = 0
+        self.car_id_step = 1
         # self.road_id = 0
 
         self.focused_car = None
 
+        # every random draw of the simulation comes from this stream so runs with
+        # the same seed are reproducible; without a seed the global random module is used
+        self.rng = random.Random(seed) if seed is not None else random
+
+        # optional struct-of-arrays engine that steps every car at once
+        self.engine = VectorEngine() if vectorized else None
+
+        # optional trajectory recorder, called at the end of every tick
+        self.recorder = None
+
+        # with routing, cars get a destination road and follow shortest paths through
+        # the lane graph, compiled again whenever the network changes
+        self.routing = routing
+        self._lane_graph = None
+        self.lane_graph_version = None
+        # routed cars waiting for a gap to change into the lane their route continues in, by
+        # car id so they are retried in the order they started waiting, whatever their addresses
+        self.route_lane_changes = {}
+        # simulated seconds between updates of the routes to the current congestion, or None
+        self.reroute_interval = reroute_interval
+        self.time_since_reroute = 0
+        self.rerouted_cars = 0
+
         self.scenario = scenario
-        # set the road map from the scenario file
+        # the scenario compiled to a checked network, built by add_roads, with its
+        # geometry read from the cache in this directory if given
+        self.network = None
+        self.geometry_cache = GeometryCache(geometry_cache) if geometry_cache else None
         if self.scenario:
-            self.parse_road_map()
+            self.network = scenario if isinstance(scenario, Network) else Network.from_scenario(scenario)
 
-    
-    def parse_road_map(self):
-        self.road_map = {}
-        
-        if self.scenario.road_map:
-            # convert the road_map string to a map
-            for road_string in self.scenario.road_map:
-                road_split = road_string.split('-')
-                if len(road_split) != 2:
-                    logging.warning(f'Invalid road map string {road_string}')
-                    continue
-                
-                out_string, in_string = road_split[0], road_split[1]
-
-                out_split = out_string.split('.')
-                in_split = in_string.split('.')
-
-                if len(out_split) != 2 or len(in_split) != 2:
-                    logging.warning(f'Invalid road map string{road_string}')
-                    continue
-                
-                out_road, out_lane = int(out_split[0]), int(out_split[1])
-                in_road, in_lane = int(in_split[0]), int(in_split[1])
-
-                if out_road not in self.road_map:
-                    self.road_map[out_road] = {}
-                
-                if out_lane not in self.road_map[out_road]:
-                    self.road_map[out_road][out_lane] = {}
-                
-                if in_road not in self.road_map[out_road][out_lane]:
-                    self.road_map[out_road][out_lane][in_road] = [in_lane]
-                else:
-                    self.road_map[out_road][out_lane][in_road].append(in_lane)
 
-    
     def add_car(self):
         if self.road_ends:
-            road = random.choice(self.road_ends)
-            lane = random.choice(road.lanes)
-
-            car_args = CarGenerator.generate_car()
-
-            # check if we can add a car to this lane without causing an accident
-            if lane.last_car:
-                if lane.last_car.x - lane.last_car.l/2 > car_args['l']/2*self.ppm + car_args['s_0']*self.ppm:
-                    # can add
-                    car = Car(car_args, car_id=self.car_id, lane=lane)
-                    self.cars[self.car_id] = car
-                    self.car_id += 1
-                else:
-                    ...
-                    # currently does not try to add to a different lane in the failure case.
-                    # could alternatively randomly choose another lane from the remaining lanes,
-                    # but this could break other traffic rules.
-            else:
-                car = Car(car_args, car_id=self.car_id, lane=lane)
-                self.cars[self.car_id] = car
-                self.car_id += 1
+            road = self.rng.choice(self.road_ends)
+            lane = self.rng.choice(road.lanes)
+
+            car_args = CarGenerator.generate_car(rng=self.rng)
+            self.enqueue_car(car_args, lane)
         else:
             logging.warning('No road for car to be added to.')
 
 
+    def can_enter(self, car_args, lane):
+        # check if we can add a car to this lane without causing an accident
+        last_car = lane.last_car
+        return not last_car or last_car.x - last_car.l/2 > car_args['l']/2*self.ppm + car_args['s_0']*self.ppm
+
+
+    def enqueue_car(self, car_args, lane):
+        """
+        Add a car to the start of a lane if there is room and no car is waiting,
+        otherwise to the entry queue of the lane. Cars arriving at a full queue are
+        dropped and counted.
+        Returns the car if it entered the lane.
+        """
+        queue = self.entry_queues.get(lane)
+        if not queue and self.can_enter(car_args, lane):
+            return self.spawn_car(car_args, lane)
+
+        if queue is None:
+            queue = self.entry_queues[lane] = deque()
+        if len(queue) >= ENTRY_QUEUE_CAPACITY:
+            self.dropped_cars += 1
+        else:
+            queue.append((self.time, car_args))
+
+
+    def release_entry_queues(self):
+        """
+        Move waiting cars onto their lanes as soon as there is room
+        """
+        for lane, queue in list(self.entry_queues.items()):
+            while queue and self.can_enter(queue[0][1], lane):
+                arrival, car_args = queue.popleft()
+                self.entry_delay += self.time - arrival
+                self.spawn_car(car_args, lane)
+            if not queue:
+                del self.entry_queues[lane]
+
+
+    @property
+    def queued_cars(self):
+        return sum(len(queue) for queue in self.entry_queues.values())
+
+
+    @property
+    def lane_graph(self):
+        if self.lane_graph_version != self.network_version:
+            self._lane_graph = LaneGraph(self.roads)
+            self.lane_graph_version = self.network_version
+        return self._lane_graph
+
+
+    def spawn_car(self, car_args, lane):
+        car = Car(car_args, car_id=self.car_id, lane=lane)
+        self.insert_car(car)
+        self.car_id += self.car_id_step
+        self.spawned_cars += 1
+
+        if self.routing:
+            destinations = self.lane_graph.reachable_destinations(lane)
+            if destinations:
+                car.destination = self.rng.choice(destinations)
+                self.follow_route(car)
+
+        return car
+
+
+    def follow_route(self, car):
+        if not car.follow_route(self.lane_graph, rng=self.rng):
+            self.route_lane_changes[car.car_id] = car
+
+
+    def retry_route_lane_changes(self):
+        for car_id, car in list(self.route_lane_changes.items()):
+            if car_id not in self.cars or car.follow_route(self.lane_graph, rng=self.rng):
+                del self.route_lane_changes[car_id]
+
+
+    def reroute(self):
+        """
+        Weight the lane graph by the current travel times and re-plan the cars
+        heading for destinations whose routes changed. Only cars whose next lane
+        or junction lane changed count as rerouted.
+        """
+        graph = self.lane_graph
+        steps = {car_id: graph.route_step(car.lane, car.destination)
+                 for car_id, car in self.cars.items() if car.destination is not None}
+        repaired = set(graph.update_weights(congestion_costs(graph.lanes)))
+        if not repaired:
+            return
+
+        for car_id, car in self.cars.items():
+            if car.destination in repaired:
+                if graph.route_step(car.lane, car.destination) != steps[car_id]:
+                    self.rerouted_cars += 1
+                self.follow_route(car)
+
+
     def change_lanes(self):
-        car_id = random.choice(list(self.cars.keys()))
-        self.cars[car_id].change_lane()
+        if not self.cars:
+            return
+
+        car_id = self.rng.choice(list(self.cars.keys()))
+        car = self.cars[car_id]
+        if self.routing and car.destination is not None:
+            # routed cars only change lanes to stay on their route
+            self.follow_route(car)
+        else:
+            car.change_lane(rng=self.rng)
 
     
-    def add_road(self, road_coords, n_lanes):
+    def add_road(self, road_coords, n_lanes, one_way=False):
         """
         Creates and adds a new Road.
         Returns the added Road
         """
-        road = Road(road_coords, n_lanes=n_lanes)
+        road = Road(road_coords, n_lanes=n_lanes, one_way=one_way)
         self.roads.append(road)
         self.road_ends.append(road)
+        self.network_version += 1
         return road
 
     
@@ -130,27 +261,28 @@ class Simulation:
             in_lane.prev_junctions.append(junction)
 
         self.junctions.append(junction)
+        self.network_version += 1
         
     
     def add_roads(self):
-        # build the roads
-        for road_id, road in enumerate(self.scenario.roads):
-            # create the new road
-            new_road = Road(road['endpoints'], n_lanes=road['n_lanes'])
-            self.roads.append(new_road)
-            if road['is_source']:
-                self.road_ends.append(new_road)
-        
-        # build the junctions and connect the roads
-        if self.road_map:
-            for out_road, out_lanes in self.road_map.items():
-                for out_lane, in_roads in out_lanes.items():
-                    for in_road, in_lanes in in_roads.items():
-                        for in_lane in in_lanes:
-                            self.add_junction(out_road, out_lane, in_road, in_lane)
-    
+        self.add_network(self.network)
+
 
-    def add_roads_from_path(self, path, n_lanes):
+    def add_network(self, network):
+        """
+        Build the roads of a Network and connect their lanes with junctions
+        """
+        first = len(self.roads)
+        roads = self.geometry_cache.build_roads(network) if self.geometry_cache else network.build_roads()
+        self.roads.extend(roads)
+        self.road_ends.extend(road for road, is_source in zip(roads, network.is_source.tolist()) if is_source)
+        self.network_version += 1
+
+        for out_road, out_lane, in_road, in_lane in network.links.tolist():
+            self.add_junction(first + out_road, out_lane, first + in_road, in_lane)
+
+
+    def add_roads_from_path(self, path, n_lanes, one_way=False):
         # path = tuple(((p0, p1) for p0, p1 in zip(path[:-1], path[1:])))
 
         # for road_id, endpoints in enumerate(path):
@@ -160,55 +292,155 @@ class Simulation:
 
         #     if road_id == 0:
         #         self.road_ends.append(new_road)
-        new_road = Road(path, n_lanes=n_lanes)
+        new_road = Road(path, n_lanes=n_lanes, one_way=one_way)
         self.roads.append(new_road)
         self.road_ends.append(new_road)
+        self.network_version += 1
 
     
+    def insert_car(self, car):
+        """
+        Add a car that is already on its lane to the simulation
+        """
+        self.cars[car.car_id] = car
+        if self.engine:
+            self.engine.add(car)
+        self.min_headway = min(self.min_headway, car.T)
+
+
     def remove_car(self, car_id):
         car = self.cars[car_id]
-        if car.trail_car:
-            car.trail_car.lead_car = None
-        else:
-            car.lane.last_car = None
-        del car.lane.cars[car_id]
+        car.lane.remove_car(car)
         del self.cars[car_id]
 
+        if car.engine:
+            car.engine.remove(car)
+        if car.T <= self.min_headway:
+            self.min_headway_stale = True
+
+
+    def end_of_lane(self, car):
+        # check if there is a junction
+        if car.lane.next_junction:
+            # change to that road potentially
+            car.cross_junction(rng=self.rng, routes=self.lane_graph if self.routing else None)
+            if self.routing and car.destination is not None:
+                self.follow_route(car)
+            ...
+        else:
+            self.dead_cars.append(car.car_id)
+            car.x = car.lane.length
+
+            if self.routing and car.destination is not None:
+                graph = self.lane_graph
+                if graph.lane_roads[graph.index[car.lane]] == car.destination:
+                    self.arrived_cars += 1
+
 
     def clean_roads(self):
         while self.dead_cars:
             car_id = self.dead_cars.pop()
             self.remove_car(car_id)
+            self.exited_cars += 1
+
+
+    def get_substeps(self):
+        """
+        Number of integration steps for the next tick. Steps longer than
+        STABLE_STEP_FRACTION of the shortest time headway on the road are split further,
+        since the car-following model overshoots its gaps when integrated that coarsely.
+        At most MAX_SUBSTEPS steps are taken, and a headway that is not positive is an error.
+        """
+        if self.min_headway_stale:
+            self.min_headway = min((car.T for car in self.cars.values()), default=math.inf)
+            self.min_headway_stale = False
+
+        T_min = self.min_headway
+        if T_min == math.inf:
+            return self.substeps
+        if T_min <= 0:
+            raise ValueError(f'car time headway must be positive, got {T_min}s')
+
+        stable = min(math.ceil(self.dt / (STABLE_STEP_FRACTION*T_min) - 1e-9), MAX_SUBSTEPS)
+        if stable > self.substeps and not self.warned_substeps:
+            logging.warning(f'Timestep {self.dt}s is too long for a {T_min:.2f}s headway, '
+                            f'using {stable} sub-steps instead of {self.substeps}'
+                            f'{" (capped at MAX_SUBSTEPS)" if stable == MAX_SUBSTEPS else ""}.')
+            self.warned_substeps = True
+
+        return max(self.substeps, stable)
 
 
     def update(self):
-        for car_id, car in self.cars.items():
-            if car_id not in self.dead_cars:
-                if not car.update():
-                    # car has reached the end of its path
-                    # check if there is a junction
-                    if car.lane.next_junction:
-                        # change to that road potentially
-                        car.cross_junction()
-                        ...
-                    else:
-                        self.dead_cars.append(car_id)
-                        car.x = car.lane.length
-        
-        self.clean_roads()
-        
-        if self.roads:
-            self.ticks_since_car += 1
-            if self.ticks_since_car >= 150/len(self.road_ends):
+        self.tick += 1
+
+        substeps = self.get_substeps()
+        dt = self.dt/substeps
+
+        for _ in range(substeps):
+            if self.engine:
+                # step every car at once and only visit those leaving their lane
+                for car in self.engine.step(dt):
+                    self.end_of_lane(car)
+                passed = self.engine.passed_lanes
+            else:
+                passed = set()
+                for car_id, car in self.cars.items():
+                    if car_id not in self.dead_cars:
+                        lead = car.lead_car
+                        if not car.update(dt):
+                            # car has reached the end of its path
+                            self.end_of_lane(car)
+                        elif lead is not None and car.x > lead.x:
+                            # cars never move backwards, so this catches every car that passed its leader
+                            passed.add(car.lane)
+
+            # keep the position order of lanes where a car passed another, for neighbor queries
+            for lane in passed:
+                lane.sort_cars()
+
+            self.clean_roads()
+
+        if self.route_lane_changes:
+            self.retry_route_lane_changes()
+
+        start = self.time
+        self.time += self.dt
+
+        if self.demand:
+            # arrivals over the tick just simulated
+            self.demand.update(self, start)
+        elif self.road_ends:
+            # small tolerance so intervals that are a whole number of ticks are not
+            # pushed back a tick by rounding
+            self.time_since_car += self.dt
+            if self.time_since_car >= self.spawn_interval/len(self.road_ends) - 1e-9:
                 self.add_car()
-                self.ticks_since_car = 0
+                self.time_since_car = 0
+
+        if self.entry_queues:
+            self.release_entry_queues()
             
-            self.ticks_since_lane_change += 1
-            if self.ticks_since_lane_change >= 400:
+        if self.roads:
+            self.time_since_lane_change += self.dt
+            if self.time_since_lane_change >= self.lane_change_interval - 1e-9:
                 self.change_lanes()
-                self.ticks_since_lane_change = 0
+                self.time_since_lane_change = 0
+
+        if self.routing and self.reroute_interval:
+            self.time_since_reroute += self.dt
+            if self.time_since_reroute >= self.reroute_interval - 1e-9:
+                self.reroute()
+                self.time_since_reroute = 0
+
+        if self.recorder:
+            self.recorder.record(self)
 
 
-    def run_sim(self):
-        for tick in range(self.sim_len):
-            self.movement()
\ No newline at end of file
+    def run_sim(self, n_ticks=None):
+        """
+        Advance the simulation without rendering for n_ticks, or sim_len ticks by default.
+        Each tick advances the simulated time by dt seconds.
+        """
+        for tick in range(self.sim_len if n_ticks is None else n_ticks):
+            self.update()
@@ -0,0 +1,80 @@
+"""
+Uniform grid spatial index for viewport culling.
+"""
+from parameters import GRID_CELL_SIZE
+
+import numpy as np
+
+import math
+
+
+class UniformGrid:
+    """
+    Index of items by axis-aligned bounding box (x1, y1, x2, y2). Every item is
+    registered in each grid cell its box overlaps, so a query only visits the
+    cells under the query rectangle.
+    """
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.items = []
+        self.bboxes = np.empty((0, 4))
+
+
+    def cell_range(self, bbox):
+        x1, y1, x2, y2 = bbox
+        c = self.cell_size
+        return range(math.floor(x1/c), math.floor(x2/c)+1), range(math.floor(y1/c), math.floor(y2/c)+1)
+
+
+    def build(self, items, bboxes):
+        """
+        Index the items with their bounding boxes, replacing what was indexed before
+        """
+        self.items = list(items)
+        self.bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+        self.cells = {}
+
+        for i, bbox in enumerate(self.bboxes):
+            xs, ys = self.cell_range(bbox)
+            for cx in xs:
+                for cy in ys:
+                    self.cells.setdefault((cx, cy), []).append(i)
+
+
+    def query(self, bbox):
+        """
+        Return the items whose bounding boxes intersect bbox
+        """
+        xs, ys = self.cell_range(bbox)
+        if len(xs)*len(ys) >= len(self.items):
+            # the rectangle covers more cells than there are items, test every item
+            candidates = np.arange(len(self.items))
+        else:
+            candidates = {i for cx in xs for cy in ys for i in self.cells.get((cx, cy), ())}
+            candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+
+        x1, y1, x2, y2 = bbox
+        boxes = self.bboxes[candidates]
+        hit = (boxes[:, 0] <= x2) & (boxes[:, 2] >= x1) & (boxes[:, 1] <= y2) & (boxes[:, 3] >= y1)
+
+        return [self.items[i] for i in np.sort(candidates[hit])]
+
+
+def lane_bbox(lane, padding=0):
+    """
+    Bounding box of a lane. A Bezier curve lies inside the hull of its control
+    points, so their extent bounds the whole lane.
+    """
+    points = np.asarray(lane.control_points).reshape(-1, 2)
+    (x1, y1), (x2, y2) = points.min(axis=0), points.max(axis=0)
+    return x1 - padding, y1 - padding, x2 + padding, y2 + padding
+
+
+def in_bbox(points, bbox):
+    """
+    Mask of the points of shape (n, 2) that lie inside bbox
+    """
+    points = np.asarray(points).reshape(-1, 2)
+    x1, y1, x2, y2 = bbox
+    return (points[:, 0] >= x1) & (points[:, 0] <= x2) & (points[:, 1] >= y1) & (points[:, 1] <= y2)
@@ -1,23 +1,26 @@
 import dearpygui.dearpygui as dpg
+import numpy as np
 
 from car import Car, CarGenerator
 from road import Road
 from junction import Junction
-from sim import Simulation
+from sim import Simulation, load_scenario
+from recorder import TrajectoryReader
+from spatial import UniformGrid, lane_bbox, in_bbox
+from worker import SimulationWorker
 from parameters import *
 from math_functions import get_normal_vector
 from bezier import Bezier, LinearBezier
 
-import scenarios.scen1 as scen1
-import scenarios.scen2 as scen2
-import scenarios.scen3 as scen3
-import scenarios.scen4 as scen4
-
 import logging
 import random
 import argparse
+import contextlib
 import time
 
+# target real-time factors of the simulation worker, None steps as fast as possible
+SIM_RATES = {'Pause': 0, '1x': 1, '10x': 10, 'Max': None}
+
 class Window:
     def __init__(self):
         # config init
@@ -27,6 +30,32 @@ class Window:
         self.canvas_bounds = [[0, 0], [CANVAS_WIDTH, CANVAS_HEIGHT]]
         self.ppm = 1 # "pixels per meter" - scaling factor
 
+        # the simulation is stepped on a background worker, independent of the frame rate
+        self.sim = None
+        self.worker = None
+        self.sim_rate = 1
+        self.fast_forwarding = False
+
+        # retained canvas state: the network the road layer was built for, the view
+        # transform applied to the world layers, and the items of every drawn car
+        self.drawn_network = None
+        self.view = None
+        self.car_items = {}
+        self.drawn_cars = set()
+
+        # spatial index of the lanes, used to only draw what is in view
+        self.lane_grid = UniformGrid()
+        self.lane_nodes = {}
+        self.visible_lanes = []
+
+        # the logging panel is refreshed at LOG_RATE, not every frame
+        self.log_interval = 1/LOG_RATE
+        self.last_log = 0
+        self.logged_network = None
+        # (name, lane) of every lane listed in the lane table, and the cells of its rows
+        self.logged_lanes = []
+        self.lane_table_rows = []
+
         # visualization initialization
         # rewriting this form to solve inheritence issue
         Window.setup_dpg(self)
@@ -48,51 +77,120 @@ class Window:
         return self.canvas_bounds[1][0] - self.canvas_bounds[0][0]
 
 
+    def view_bbox(self, margin=50):
+        """
+        The world rectangle shown on the canvas, padded by margin canvas pixels
+        """
+        (x0, y0), ppm = self.canvas_bounds[0], self.ppm
+        return (x0 - margin)/ppm, (y0 - margin)/ppm, (x0 + CANVAS_WIDTH + margin)/ppm, (y0 + CANVAS_HEIGHT + margin)/ppm
+
+
     def draw_bezier(self, bezier):
+        # drawn in world coordinates, the road layer transform maps them to the canvas
         if isinstance(bezier, LinearBezier):
             P0, P1, P2, P3 = bezier.P0, bezier.P0, bezier.P1, bezier.P1
         else:
             P0, P1, P2, P3 = bezier.P0, bezier.P1, bezier.P2, bezier.P3
-        
-        # P0, P1, P2, P3 = self.unshift_xy(*P0), self.unshift_xy(*P1), self.unshift_xy(*P2), self.unshift_xy(*P3)
-        # dpg.draw_bezier_cubic(P0, P1, P2, P3, color=(100, 100, 100, 200), thickness=LANE_WIDTH)
-            
-        control_points = [P0, P1, P2, P3]
-        for i, (x, y) in enumerate(control_points):
-            x *= self.ppm
-            y *= self.ppm
-            x, y = self.unshift_xy(x, y)
-            control_points[i] = [x, y]
 
+        control_points = [[float(x), float(y)] for x, y in (P0, P1, P2, P3)]
         dpg.draw_bezier_cubic(*control_points, color=(100, 100, 100, 200), thickness=LANE_WIDTH)
     
 
-    def draw_crosshair(self, x, y):
-        dpg.draw_line((x, y-4), (x, y+5))
-        dpg.draw_line((x-4, y), (x+5, y))
+    def draw_crosshair(self, x, y, tag=0, parent=0):
+        with dpg.draw_node(tag=tag, parent=parent):
+            dpg.draw_line((x, y-4), (x, y+5))
+            dpg.draw_line((x-4, y), (x+5, y))
+
+
+    def sim_lock(self):
+        """
+        Hold while reading or changing the simulation outside of the worker thread
+        """
+        return self.worker.lock if self.worker else contextlib.nullcontext()
+
+
+    def start_worker(self):
+        if self.worker:
+            self.worker.stop()
+        self.worker = SimulationWorker(self.sim, rate=self.sim_rate).start()
 
 
     def handle_add_car(self):
         if self.sim:
-            self.sim.add_car()
+            with self.sim_lock():
+                self.sim.add_car()
 
     
     def handle_step(self):
-        self.render_loop()
+        if self.worker:
+            self.worker.request_steps(1)
+        else:
+            self.render_loop()
     
 
     def handle_step_100(self):
-        for _ in range(100):
-            self.handle_step()
+        if self.worker:
+            self.worker.request_steps(100)
+        else:
+            for _ in range(100):
+                self.handle_step()
+
+
+    def handle_fast_forward(self):
+        if not self.worker:
+            return
+
+        if self.worker.fast_forwarding:
+            self.worker.cancel_fast_forward()
+            return
+
+        amount = dpg.get_value('Fast Forward Amount')
+        if dpg.get_value('Fast Forward Unit') == 'seconds':
+            ticks = int(round(amount / self.sim.dt))
+        else:
+            ticks = int(amount)
+        if ticks <= 0:
+            return
+
+        self.worker.fast_forward(ticks)
+        self.fast_forwarding = True
+        dpg.configure_item('Fast Forward Button', label='Cancel')
+        dpg.configure_item('Fast Forward Progress', show=True)
+
+
+    def render_fast_forward(self):
+        """
+        Show the progress of a fast-forward. Returns whether one is still running.
+        """
+        worker = self.worker
+        if worker.fast_forwarding:
+            dpg.set_value('Fast Forward Progress', worker.fast_forward_progress)
+            dpg.configure_item('Fast Forward Progress',
+                               overlay=f'{worker.fast_forward_done}/{worker.fast_forward_total} ticks')
+            return True
+
+        self.fast_forwarding = False
+        dpg.configure_item('Fast Forward Button', label='Fast Forward')
+        dpg.configure_item('Fast Forward Progress', show=False)
+        return False
+
+
+    def handle_rate(self, sender, app_data):
+        self.sim_rate = SIM_RATES[app_data]
+        if self.worker:
+            self.worker.set_rate(self.sim_rate)
     
 
     def handle_change_lanes(self):
         if self.sim:
-            self.sim.change_lanes()
+            with self.sim_lock():
+                self.sim.change_lanes()
 
 
     def handle_toggle_car_ids(self):
         self.show_car_ids = not self.show_car_ids
+        for _, label in self.car_items.values():
+            dpg.configure_item(label, show=self.show_car_ids)
 
     
     def handle_toggle_mouse_pos(self):
@@ -101,7 +199,9 @@ class Window:
     
     def handle_log_car(self):
         if self.sim:
-            self.sim.focused_car = self.sim.cars[int(dpg.get_value('Log Car ID'))]
+            with self.sim_lock():
+                self.sim.focused_car = self.sim.cars[int(dpg.get_value('Log Car ID'))]
+            self.render_logging(force=True)
 
 
     # initialization calls to dpg
@@ -124,12 +224,32 @@ class Window:
         
         dpg.bind_item_theme(window, canvas_theme)
 
+        # canvas layers, back to front: roads and cars are drawn in world
+        # coordinates and moved with the view transform, the overlay is in canvas coordinates
+        dpg.add_draw_node(tag='Road Layer', parent=window)
+        dpg.add_draw_node(tag='Car Layer', parent=window)
+        with dpg.draw_node(tag='Overlay Layer', parent=window):
+            dpg.draw_text((5, 5), '', tag='Canvas Bounds', size=FONT_SIZE)
+            with dpg.draw_node(tag='Mouse Pos', show=False):
+                dpg.draw_text((0, 0), '', tag='Mouse Pos Text', size=FONT_SIZE)
+                self.draw_crosshair(0, 0, tag='Mouse Pos Crosshair')
+
         dpg.set_primary_window(window, True)
         # self.CANVAS_WIDTH, self.CANVAS_HEIGHT = dpg.get_item_rect_size(window)
 
         with dpg.window(label='Moderation', tag='Moderation', no_resize=True, no_close=True, pos=(CANVAS_WIDTH-350, 50), width=300):
+            dpg.add_radio_button(list(SIM_RATES), tag='Sim Rate', default_value='1x', horizontal=True,
+                                 callback=self.handle_rate)
+            dpg.add_text('', tag='Sim Status')
             dpg.add_button(label='Step', callback=self.handle_step)
             dpg.add_button(label='Step (x100)', callback=self.handle_step_100)
+
+            # advance without drawing, the canvas is redrawn once the fast-forward is done
+            with dpg.group(horizontal=True):
+                dpg.add_input_float(tag='Fast Forward Amount', default_value=60, width=100, step=0)
+                dpg.add_combo(['seconds', 'ticks'], tag='Fast Forward Unit', default_value='seconds', width=80)
+            dpg.add_button(label='Fast Forward', tag='Fast Forward Button', callback=self.handle_fast_forward)
+            dpg.add_progress_bar(tag='Fast Forward Progress', width=-1, show=False)
             dpg.add_button(label='Change Lanes', callback=self.handle_change_lanes)
             dpg.add_button(label='Toggle Car IDs', callback=self.handle_toggle_car_ids)
             dpg.add_button(label='Toggle Mouse Pos', callback=self.handle_toggle_mouse_pos)
@@ -138,40 +258,55 @@ class Window:
             dpg.add_button(label='Log Car', callback=self.handle_log_car)
 
         with dpg.window(label='Logging', tag='Logging', no_close=True, pos=(50, 750), width=CANVAS_WIDTH-100, height=400):
-            ...
+            # one text item per diagnostic field, updated in place
+            with dpg.group(tag='Focused Car Log', show=False):
+                for field in Car.DIAGNOSTIC_FIELDS:
+                    dpg.add_text(f'{field}:', tag=f'Log {field}')
+
+            with dpg.group(horizontal=True):
+                dpg.add_checkbox(label='Show Lanes', tag='Show Lanes')
+                dpg.add_slider_int(label='First Lane', tag='Lane Table Start', width=300, show=False)
+            # a fixed set of rows showing the lanes from 'First Lane' on, so a refresh
+            # only touches LANE_TABLE_ROWS rows however large the network is
+            with dpg.table(tag='Lane Table', header_row=True, show=False,
+                           borders_innerV=True, borders_outerH=True, row_background=True):
+                dpg.add_table_column(label='Lane', width_fixed=True)
+                dpg.add_table_column(label='Endpoints', width_fixed=True)
+                dpg.add_table_column(label='Cars', width_fixed=True)
+                dpg.add_table_column(label='Car IDs')
+                for _ in range(LANE_TABLE_ROWS):
+                    with dpg.table_row(show=False) as row:
+                        cells = [dpg.add_text('') for _ in range(4)]
+                    self.lane_table_rows.append((row, cells))
 
         # dpg.apply_transform('road 1', dpg.create_translation_matrix([250, 250]))
 
     
-    def setup_sim(self):
-        scenario = scen4
-        self.sim = Simulation(scenario=scenario)
+    def setup_sim(self, scenario='scen4'):
+        # scenarios are imported on demand so only the one being run is loaded
+        self.sim = Simulation(scenario=load_scenario(scenario))
 
         self.sim.add_roads()
+        self.start_worker()
 
 
     def render_loop(self):
-        dpg.delete_item('Canvas', children_only=True)
-        dpg.delete_item('Logging', children_only=True)
+        if self.fast_forwarding and self.render_fast_forward():
+            # nothing is drawn until the fast-forward finishes
+            return
 
         ## LOGGING
         # Mouse position
         if self.show_mouse_pos:
-            with dpg.draw_node(tag='Mouse Pos', parent='Canvas'):
-                mouse_pos = dpg.get_mouse_pos(local=False)
-                dpg.draw_text((mouse_pos[0]-5, mouse_pos[1]-20), f'{mouse_pos}', size=FONT_SIZE)
-                self.draw_crosshair(mouse_pos[0], mouse_pos[1])
+            mouse_pos = dpg.get_mouse_pos(local=False)
+            dpg.configure_item('Mouse Pos Text', pos=(mouse_pos[0]-5, mouse_pos[1]-20), text=f'{mouse_pos}')
+            dpg.apply_transform('Mouse Pos Crosshair', dpg.create_translation_matrix(mouse_pos))
+        dpg.configure_item('Mouse Pos', show=self.show_mouse_pos)
         
         # Canvas Bounds
-        with dpg.draw_node(tag='Canvas Bounds', parent='Canvas'):
-            dpg.draw_text((5, 5), f'Canvas Bounds: {self.canvas_bounds}', size=FONT_SIZE)
+        dpg.configure_item('Canvas Bounds', text=f'Canvas Bounds: {self.canvas_bounds}')
 
-        # Focused car details
-        if self.sim.focused_car:
-            diag = self.sim.focused_car.get_diagnostics()
-            dpg.add_text(self.sim.focused_car.car_id, parent='Logging')
-            for car_id in diag.values():
-                dpg.add_text(car_id, parent='Logging')
+        self.render_logging()
 
         # render junctions
         # for junction_id, junction in enumerate(self.sim.junctions):
@@ -181,51 +316,180 @@ class Window:
         #         with dpg.draw_node(tag=f'Junction {junction_id}.{lane_id}', parent='Canvas'):
         #             dpg.draw_line((x1, y1), (x2, y2), color=(150, 150, 150, 200), thickness=LANE_WIDTH)
 
-        # Render roads
+        # the road layer is only rebuilt when the network changes
+        network = (self.sim, self.sim.network_version)
+        network_changed = network != self.drawn_network
+        if network_changed:
+            self.render_roads()
+            self.drawn_network = network
+
+        if self.apply_view() or network_changed:
+            self.cull_lanes()
+
+        self.drawn_cars = set()
+        self.render_cars()
+        self.remove_stale_cars()
+        
+        self.update()
+
+
+    def render_logging(self, force=False):
+        """
+        Refresh the logging panel, at most once every log_interval seconds
+        """
+        now = time.perf_counter()
+        if not force and now - self.last_log < self.log_interval:
+            return
+        self.last_log = now
+
+        if self.worker:
+            speed = 'max' if self.worker.rate is None else f'{self.worker.rate}x'
+            dpg.set_value('Sim Status', f'Time: {self.worker.snapshot.time:.1f}s, '
+                                        f'{self.worker.speed:.1f}x real time (target {speed})')
+
+        with self.sim_lock():
+            # Focused car details
+            car = self.sim.focused_car
+            dpg.configure_item('Focused Car Log', show=car is not None)
+            if car:
+                for field, value in car.get_diagnostics().items():
+                    dpg.set_value(f'Log {field}', f'{field}: {value}')
+
+            # lane summaries are only computed while the table is shown
+            show_lanes = dpg.get_value('Show Lanes')
+            dpg.configure_item('Lane Table', show=show_lanes)
+            dpg.configure_item('Lane Table Start', show=show_lanes)
+            if show_lanes:
+                self.render_lane_table()
+
+
+    def render_lane_table(self):
+        # the list of lanes is rebuilt when the network changes, the rows only hold the lanes in view
+        network = (self.sim, self.sim.network_version)
+        if network != self.logged_network:
+            self.logged_lanes = [(f'{road_id}-{lane_id}', lane)
+                                 for road_id, road in enumerate(self.sim.roads)
+                                 for lane_id, lane in enumerate(road.lanes) if not lane.is_key]
+            dpg.configure_item('Lane Table Start', max_value=max(0, len(self.logged_lanes) - LANE_TABLE_ROWS))
+            self.logged_network = network
+
+        start = min(dpg.get_value('Lane Table Start'), max(0, len(self.logged_lanes) - LANE_TABLE_ROWS))
+        lanes = self.logged_lanes[start:start + LANE_TABLE_ROWS]
+        for i, (row, (name, endpoints, count, car_ids)) in enumerate(self.lane_table_rows):
+            dpg.configure_item(row, show=i < len(lanes))
+            if i >= len(lanes):
+                continue
+            lane_name, lane = lanes[i]
+            (x1, y1), (x2, y2) = lane.endpoints
+            dpg.set_value(name, lane_name)
+            dpg.set_value(endpoints, f'({x1}, {y1}), ({x2}, {y2})')
+            dpg.set_value(count, len(lane.cars))
+            dpg.set_value(car_ids, ', '.join(map(str, lane.cars)))
+
+
+    def render_roads(self):
+        dpg.delete_item('Road Layer', children_only=True)
+        self.lane_nodes = {}
+
         for road_id, road in enumerate(self.sim.roads):
             for lane_id, lane in enumerate(road.lanes):
                 if lane.is_key:
                     continue
-                dpg.add_text(f'Lane {road_id}-{lane_id}: {[car_id for car_id in lane.cars.values()]}', parent='Logging')
-                # dpg.delete_item(f'Road {road_id}.{lane_id}')
-                (x1, y1), (x2, y2) = lane.endpoints
-                with dpg.draw_node(tag=f'Road {road_id}.{lane_id}', parent='Canvas'):
-                    dpg.add_text(f'({x1}, {y1}), ({x2}, {y2})', parent='Logging')
+                with dpg.draw_node(tag=f'Road {road_id}.{lane_id}', parent='Road Layer') as node:
                     # dpg.draw_polyline(lane.path, color=(120, 120, 120, 210), thickness=LANE_WIDTH)
                     for i, bezier in enumerate(lane.beziers):
                         self.draw_bezier(bezier)
+                self.lane_nodes[lane] = node
 
-                
-                # Render cars
-                for car_id, car in lane.cars.items():
-                    # dpg.delete_item(f'Car {car_id}')
-                    with dpg.draw_node(tag=f'Car {car_id}', parent='Canvas'):
-                        x1, y1 = car.compute_pos()
-                        # u1, u2 = car.unit_vec
-                        u1, u2 = car.compute_orientation()
-                        l = car.l*self.ppm/2
-                        x1, y1, x2, y2 = x1 - l*u1, y1 - l*u2, x1 + l*u1, y1 + l*u2
-
-                        # canvas navigation
-                        x1, y1 = self.unshift_xy(x1, y1)
-                        x2, y2 = self.unshift_xy(x2, y2)
-                        
-                        dpg.draw_line((x1, y1), (x2, y2), color=(50, 50, 250, 200), thickness=LANE_WIDTH*self.ppm-2)
-
-                        # dpg.draw_line((x1-90, y1), (x2+90, y2), color=(250, 10, 10, 200), thickness=2)
-                        # dpg.draw_text((x1, y1), f'{car.v:.2f}', size=10)
-                        if self.show_car_ids:
-                            dpg.draw_text((x1, y1), f'{car_id}', size=FONT_SIZE)
-        
-        self.update()
+        lanes = list(self.lane_nodes)
+        self.lane_grid.build(lanes, [lane_bbox(lane, LANE_WIDTH) for lane in lanes])
+        self.visible_lanes = lanes
+
+
+    def cull_lanes(self):
+        """
+        Show only the lanes that intersect the view, and remember them for drawing cars
+        """
+        visible = self.lane_grid.query(self.view_bbox())
+        shown = set(visible)
+        for lane in set(self.visible_lanes) ^ shown:
+            dpg.configure_item(self.lane_nodes[lane], show=lane in shown)
+
+        self.visible_lanes = visible
+
+
+    def apply_view(self):
+        """
+        Map world coordinates to the canvas: scale by ppm, then shift by the canvas offset
+        """
+        view = (self.ppm, *self.canvas_bounds[0])
+        if view == self.view:
+            return False
+
+        ppm, x0, y0 = view
+        transform = dpg.create_translation_matrix([-x0, -y0]) * dpg.create_scale_matrix([ppm, ppm])
+        dpg.apply_transform('Road Layer', transform)
+        dpg.apply_transform('Car Layer', transform)
+
+        # line thickness is in canvas pixels and does not scale with the transform
+        if not self.view or ppm != self.view[0]:
+            for line, _ in self.car_items.values():
+                dpg.configure_item(line, thickness=LANE_WIDTH*ppm-2)
+
+        self.view = view
+        return True
+
+
+    def render_cars(self):
+        # cars are drawn from the latest snapshot published by the worker
+        snapshot = self.worker.read_snapshot()
+        bbox = self.view_bbox()
+        for lane in self.visible_lanes:
+            if lane not in snapshot.lanes:
+                continue
+            car_ids, xs, lengths = snapshot.lanes[lane]
+            # positions and headings for the whole lane come from one table lookup
+            positions, headings = lane.get_positions(xs)
+            for i in np.flatnonzero(in_bbox(positions, bbox)):
+                self.draw_car(car_ids[i], positions[i], headings[i], lengths[i])
+
+
+    def draw_car(self, car_id, position, heading, length):
+        """
+        Move the items of a car, creating them the first time the car is drawn
+        """
+        (x, y), (u1, u2) = position, heading
+        l = length/2
+        p1, p2 = (x - l*u1, y - l*u2), (x + l*u1, y + l*u2)
+
+        items = self.car_items.get(car_id)
+        if items is None:
+            line = dpg.draw_line(p1, p2, parent='Car Layer', color=(50, 50, 250, 200), thickness=LANE_WIDTH*self.ppm-2)
+            label = dpg.draw_text(p1, f'{car_id}', parent='Car Layer', size=FONT_SIZE, show=self.show_car_ids)
+            self.car_items[car_id] = line, label
+        else:
+            line, label = items
+            dpg.configure_item(line, p1=p1, p2=p2)
+            if self.show_car_ids:
+                dpg.configure_item(label, pos=p1)
+
+        self.drawn_cars.add(car_id)
+
+
+    def remove_stale_cars(self):
+        """
+        Delete the items of cars that were not drawn this frame
+        """
+        for car_id in [car_id for car_id in self.car_items if car_id not in self.drawn_cars]:
+            for item in self.car_items.pop(car_id):
+                dpg.delete_item(item)
 
 
     def update(self):
         """
-        Perform all simulation related updates.
-        Includes, but is not limited to: update car positions and add/change lanes of cars
+        Per-frame updates. The simulation itself is stepped by the worker.
         """
-        self.sim.update()
+        ...
 
     
     def set_params(self):
@@ -247,6 +511,8 @@ class Window:
             self.render_loop()
             dpg.render_dearpygui_frame()
 
+        if self.worker:
+            self.worker.stop()
         dpg.destroy_context()
 
 
@@ -261,12 +527,15 @@ class InteractiveWindow(Window):
         self.build_wheel = ['Road', 'Junction']
         self.build_wheel_idx = 0
 
+        self.drawn_queue = None
+
         self.setup_canvas()
 
 
 
-    def setup_sim(self):
+    def setup_sim(self, scenario=None):
         self.sim = Simulation()
+        self.start_worker()
     
 
     def handle_add_road(self):
@@ -280,6 +549,10 @@ class InteractiveWindow(Window):
     # event handling
     def handle_canvas_click(self, sender, app_data):
         # print(f'sender: {sender}, app_data: {app_data}')
+        # clicks over the other windows (e.g. on the Add Road button) are not meant for the canvas
+        if not dpg.is_item_hovered('Canvas'):
+            return
+
         match app_data:
             case 0:
                 # left click
@@ -321,15 +594,11 @@ class InteractiveWindow(Window):
 
     def handle_left_click(self):
         if self.active_action == 'Build':
-            # wait until the canvas is focused into if it is not already
-            # this is cruicial since the button to add a road is in a different window
-            # if no wait, the first left click will show coordinates relative to the control window
-            while not dpg.is_item_focused('Canvas'):
-                ...
             mouse_pos = self.shift_xy(*dpg.get_mouse_pos(local=False))
             if self.road_queue and mouse_pos == self.road_queue[-1]:
                 # terminate road
-                self.sim.add_roads_from_path(self.road_queue, int(dpg.get_value('Lane Count')))
+                with self.sim_lock():
+                    self.sim.add_roads_from_path(self.road_queue, int(dpg.get_value('Lane Count')))
                 self.road_queue = []
                 self.active_action = None
             else:
@@ -355,8 +624,7 @@ class InteractiveWindow(Window):
             dx = int(height * scale) if direction == 'D' else int(-height * scale)
             self.canvas_bounds[1][1] += dx
             self.canvas_bounds[0][1] += dx
-        
-        dpg.set_value('Canvas Bounds', f'Canvas Bounds: {self.canvas_bounds}')
+
     
 
     def zoom_in(self, scale=1.05):
@@ -386,14 +654,19 @@ class InteractiveWindow(Window):
     def render_loop(self):
         super().render_loop()
 
-        if self.road_queue:
-            with dpg.draw_node(tag=f'Draw Queue', parent='Canvas'):
-                    for x, y in self.road_queue:
-                        x, y = self.unshift_xy(x, y)
-                        self.draw_crosshair(x, y)
+        # redraw the queued road points only when they or the view change
+        queue = (tuple(self.road_queue), self.view)
+        if queue != self.drawn_queue:
+            dpg.delete_item('Draw Queue', children_only=True)
+            for x, y in self.road_queue:
+                x, y = self.unshift_xy(x, y)
+                self.draw_crosshair(x, y, parent='Draw Queue')
+            self.drawn_queue = queue
 
 
     def setup_canvas(self):
+        dpg.add_draw_node(tag='Draw Queue', parent='Overlay Layer')
+
         with dpg.handler_registry(tag='Canvas Click Handler'):
             dpg.add_mouse_click_handler(callback=self.handle_canvas_click)
         
@@ -408,13 +681,134 @@ class InteractiveWindow(Window):
             dpg.add_slider_int(label='Lane Count', tag='Lane Count', default_value=3, min_value=1, max_value=10, clamped=True)
 
 
+class ReplayWindow(Window):
+    """
+    Plays back a recorded trajectory instead of running a simulation.
+    Playback runs at any speed, including backwards, and seeks through the
+    keyframe index of the recording without re-simulating.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.reader = TrajectoryReader(path)
+
+        # simulated seconds per real second, negative to play backwards
+        self.speed = 1.0
+        self.paused = False
+        self.last_frame = time.perf_counter()
+
+        self.replay_tick = self.reader.first_tick or 0
+        self.frame_tick, self.frame = self.reader.frame(self.replay_tick)
+
+        self.setup_replay_controls()
+
+
+    def setup_sim(self, scenario=None):
+        # only the network is rebuilt; cars come from the recording
+        self.sim = Simulation(dt=self.reader.dt)
+        for road in self.reader.manifest['roads']:
+            self.sim.add_road(road['endpoints'], road['n_lanes'], one_way=road['one_way'])
+
+
+    def setup_replay_controls(self):
+        dt = self.reader.dt
+        with dpg.window(label='Replay', tag='Replay', no_resize=True, no_close=True, pos=(CANVAS_WIDTH-350, 300), width=300):
+            dpg.add_button(label='Pause', tag='Replay Pause', callback=self.handle_toggle_pause)
+            dpg.add_button(label='Reverse', callback=self.handle_reverse)
+            dpg.add_input_float(label='Speed', tag='Replay Speed', default_value=self.speed, step=1,
+                                callback=self.handle_speed)
+            dpg.add_slider_float(label='Time (s)', tag='Replay Time', default_value=self.replay_tick*dt,
+                                 min_value=(self.reader.first_tick or 0)*dt, max_value=(self.reader.last_tick or 0)*dt,
+                                 callback=self.handle_seek)
+            dpg.add_text('', tag='Replay Tick')
+
+
+    def handle_toggle_pause(self):
+        self.paused = not self.paused
+        dpg.configure_item('Replay Pause', label='Play' if self.paused else 'Pause')
+
+
+    def handle_reverse(self):
+        self.speed = -self.speed
+        dpg.set_value('Replay Speed', self.speed)
+
+
+    def handle_speed(self, sender, app_data):
+        self.speed = app_data
+
+
+    def handle_seek(self, sender, app_data):
+        self.seek(app_data/self.reader.dt)
+
+
+    def handle_step(self):
+        # step one recorded tick in the playback direction
+        step = self.reader.every if self.speed >= 0 else -self.reader.every
+        self.seek(self.frame_tick + step)
+
+
+    def seek(self, tick):
+        """
+        Move the playback position to tick, pausing at either end of the recording
+        """
+        first, last = self.reader.first_tick or 0, self.reader.last_tick or 0
+        if not first <= tick <= last:
+            tick = min(max(tick, first), last)
+            if not self.paused:
+                self.handle_toggle_pause()
+
+        self.replay_tick = tick
+        self.frame_tick, self.frame = self.reader.frame(int(tick))
+
+
+    def update(self):
+        """
+        Advance the playback position by the real time since the last frame
+        """
+        now = time.perf_counter()
+        elapsed, self.last_frame = now - self.last_frame, now
+
+        if not self.paused:
+            self.seek(self.replay_tick + self.speed*elapsed/self.reader.dt)
+
+        dpg.set_value('Replay Time', self.frame_tick*self.reader.dt)
+        dpg.set_value('Replay Tick', f'Tick {self.frame_tick}, {len(self.frame["car_id"])} cars')
+
+
+    def render_cars(self):
+        # cull on the recorded world positions before looking anything up
+        frame = self.frame
+        rows = np.flatnonzero(in_bbox(np.column_stack((frame['px'], frame['py'])), self.view_bbox()))
+        road, lane, x, car_ids = frame['road'][rows], frame['lane'][rows], frame['x'][rows], frame['car_id'][rows]
+        if not len(x):
+            return
+        # recordings made before car lengths were recorded draw every car at the mean length
+        lengths = frame['l'][rows] if 'l' in frame else np.full(len(rows), L_MU*PPM)
+
+        # look up the headings of all cars on the same lane at once
+        keys = np.asarray(road, dtype=np.int64) << 32 | np.asarray(lane, dtype=np.int64)
+        for key in np.unique(keys):
+            rows = np.flatnonzero(keys == key)
+            road_id, lane_id = int(key >> 32), int(key & 0xffffffff)
+            if road_id < 0 or road_id >= len(self.sim.roads):
+                continue
+
+            positions, headings = self.sim.roads[road_id].lanes[lane_id].get_positions(x[rows])
+            for car_id, position, heading, length in zip(car_ids[rows], positions, headings, lengths[rows]):
+                self.draw_car(int(car_id), position, heading, float(length))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '-I', '--interactive', action='store_true')
+    parser.add_argument('-s', '--scenario', default='scen4', help='scenario module in scenarios/')
+    parser.add_argument('-r', '--replay', help='play back a trajectory recorded to this directory')
     args = parser.parse_args()
 
-    window = InteractiveWindow() if args.interactive else Window()
-    window.setup_sim()
+    if args.replay:
+        window = ReplayWindow(args.replay)
+    else:
+        window = InteractiveWindow() if args.interactive else Window()
+    window.setup_sim(args.scenario)
     window.show()
 
 
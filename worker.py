@@ -0,0 +1,206 @@
+"""
+Background stepping of a simulation, decoupled from the UI frame rate.
+"""
+import threading
+import time
+
+
+class Snapshot:
+    """
+    What a view needs to draw one tick: the cars of every occupied lane as
+    (car ids, positions along the lane, lengths)
+    """
+    def __init__(self, tick, sim_time, lanes):
+        self.tick = tick
+        self.time = sim_time
+        self.lanes = lanes
+        self.n_cars = sum(len(car_ids) for car_ids, _, _ in lanes.values())
+
+
+    @classmethod
+    def take(cls, sim):
+        lanes = {}
+        for road in sim.roads:
+            for lane in road.lanes:
+                if lane.cars:
+                    cars = list(lane.cars.values())
+                    lanes[lane] = ([car.car_id for car in cars], [car.x for car in cars], [car.l for car in cars])
+        return cls(sim.tick, sim.time, lanes)
+
+
+class SimulationWorker:
+    """
+    Steps a simulation on its own thread at a target real-time factor: rate
+    simulated seconds per real second, None to step as fast as possible, or 0
+    to only step on request.
+
+    Stepping holds lock; anything that reads or changes the simulation from
+    another thread must hold it too. After every batch of ticks a new snapshot
+    is published if the previous one has been read, so views draw from a
+    consistent copy without holding the lock.
+    """
+    def __init__(self, sim, rate=1, max_lag=0.25, batch_seconds=1/60):
+        self.sim = sim
+        self.rate = rate
+        # real seconds of stepping the worker is allowed to catch up on after falling behind
+        self.max_lag = max_lag
+        # real seconds stepped between snapshots when running as fast as possible
+        self.batch_seconds = batch_seconds
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = False
+
+        self.pending_steps = 0
+        # ticks of the current fast-forward, stepped without publishing snapshots
+        self.fast_forward_total = 0
+        self.fast_forward_done = 0
+
+        self.snapshot = Snapshot.take(sim)
+        self.snapshot_read = False
+
+        # achieved real-time factor, measured over the last second
+        self.speed = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.stopped = True
+        self.wake.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.speed = 0
+        self.wake.set()
+
+
+    def request_steps(self, n):
+        """
+        Step n ticks as soon as possible, on top of the target rate
+        """
+        with self.lock:
+            self.pending_steps += n
+        self.wake.set()
+
+
+    def fast_forward(self, ticks):
+        """
+        Step ticks ticks as fast as possible, publishing a snapshot only at the end
+        """
+        with self.lock:
+            self.fast_forward_total = ticks
+            self.fast_forward_done = 0
+        self.wake.set()
+
+
+    def cancel_fast_forward(self):
+        with self.lock:
+            self.fast_forward_total = self.fast_forward_done
+        self.wake.set()
+
+
+    @property
+    def fast_forwarding(self):
+        return self.fast_forward_done < self.fast_forward_total
+
+
+    @property
+    def fast_forward_progress(self):
+        return self.fast_forward_done / self.fast_forward_total if self.fast_forward_total else 1
+
+
+    def step_fast_forward(self):
+        deadline = time.perf_counter() + self.batch_seconds
+        while not self.stopped and time.perf_counter() < deadline:
+            with self.lock:
+                if not self.fast_forwarding:
+                    break
+                self.sim.update()
+                self.fast_forward_done += 1
+
+
+    def read_snapshot(self):
+        self.snapshot_read = True
+        return self.snapshot
+
+
+    def publish(self):
+        if self.snapshot_read:
+            with self.lock:
+                snapshot = Snapshot.take(self.sim)
+            self.snapshot = snapshot
+            self.snapshot_read = False
+
+
+    def run(self):
+        owed = 0.0
+        last = time.perf_counter()
+        window_start, window_time = last, self.sim.time
+        fast_forwarded = False
+
+        while not self.stopped:
+            # cleared before looking for work, so wake-ups during a batch are not lost
+            self.wake.clear()
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+
+            if self.fast_forwarding:
+                self.step_fast_forward()
+                fast_forwarded = True
+                # real-time stepping resumes from the end of the fast-forward
+                last = time.perf_counter()
+                window_start, window_time = last, self.sim.time
+                continue
+
+            if fast_forwarded:
+                # the fast-forward finished or was cancelled; views skip drawing while
+                # it runs, so always publish the end state, whatever the rate
+                fast_forwarded = False
+                self.snapshot_read = True
+                self.publish()
+
+            with self.lock:
+                requested, self.pending_steps = self.pending_steps, 0
+            dt = self.sim.dt
+
+            if self.rate is None:
+                deadline = now + self.batch_seconds
+                n = None
+            else:
+                owed = min(owed + elapsed*self.rate/dt, self.max_lag*self.rate/dt) if self.rate else 0
+                n = int(owed)
+                owed -= n
+
+            stepped = 0
+            while not self.stopped:
+                if n is None:
+                    if time.perf_counter() >= deadline:
+                        break
+                elif stepped >= n + requested:
+                    break
+                with self.lock:
+                    self.sim.update()
+                stepped += 1
+
+            if stepped:
+                self.publish()
+
+            if now - window_start >= 1:
+                self.speed = (self.sim.time - window_time) / (now - window_start)
+                window_start, window_time = now, self.sim.time
+
+            if self.rate is None:
+                # let other threads in between batches
+                time.sleep(0)
+            else:
+                # sleep until the next tick is due or something wakes the worker
+                timeout = (1 - owed)*dt/self.rate if self.rate else None
+                self.wake.wait(timeout)